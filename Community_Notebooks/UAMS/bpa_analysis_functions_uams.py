@@ -6,17 +6,49 @@ import sys
 import pysam
 from pysam import VariantFile
 import gzip
+import io
 import shutil
 import csv
 import bpa_analysis_functions_v2 as bp
 
 pysam.set_verbosity(0)
 
-bp.add_keys('/home/ubuntu/.secrets')
+if os.path.exists('/home/ubuntu/.secrets'):
+    bp.add_keys('/home/ubuntu/.secrets')
 
-def download_file(project, profile, path, file_name):
-    ''' Automates downloading files and compressed files (and extracting) if a local copy does not exist '''
+def download_file(project, profile, path, file_name, extract=True):
+    ''' Automates downloading files and compressed files (and extracting, unless extract is False) if a local copy
+        does not exist. Returns the name of the local copy to read. '''
     
+    if file_name.endswith('.gz'):
+        unzipped_file_name = file_name[:-len('.gz')]
+    else:
+        unzipped_file_name = file_name
+
+    # with the shared data cache enabled the copy is always verified against the cache manifest
+    # instead of trusting any file that happens to exist locally
+    if bp.data_cache is not None:
+        print("Fetching through the local data cache: " + file_name)
+        bp.get_files_from_bucket(project, profile, path, file_name)
+        if extract and file_name.endswith('.gz') and os.path.isfile(path + file_name):
+            # the .gz is a link into the cache and is kept, so the next call finds it up to date; the extracted
+            # copy is only rebuilt when the cached object it came from changes
+            checksum = bp.data_cache.source_checksum(project.replace('bpa-', 'BPA_') + '/' + file_name)
+            checksum_file = path + unzipped_file_name + '.checksum'
+            if (checksum is not None and os.path.isfile(path + unzipped_file_name) and
+                    os.path.isfile(checksum_file) and open(checksum_file).read().strip() == checksum):
+                print("Local extracted file copy found: " + unzipped_file_name)
+            else:
+                if os.path.isfile(checksum_file):
+                    os.remove(checksum_file)
+                print("Extracting file: " + file_name)
+                extract_gz_file(path + file_name, remove=False)
+                if checksum is not None:
+                    with open(checksum_file, 'w') as f:
+                        f.write(checksum)
+        print('-'*80)
+        return unzipped_file_name if extract else file_name
+
     # file is not compressed
     if not file_name.endswith('.gz'):        
 
@@ -27,9 +59,21 @@ def download_file(project, profile, path, file_name):
             print("Local file copy not found, downloading: " + file_name)
             bp.get_files_from_bucket(project, profile, path, file_name)
 
+    # file is compressed and is read as is (pysam and the importers stream .gz/BGZF files)
+    elif not extract:
+
+        if os.path.isfile(path + file_name):
+            print("Local compressed file copy found: " + file_name)
+        # extracted by an earlier run
+        elif os.path.isfile(path + unzipped_file_name):
+            print("Local extracted file copy found: " + unzipped_file_name)
+            file_name = unzipped_file_name
+        else:
+            print("Downloading file: " + file_name)
+            bp.get_files_from_bucket(project, profile, path, file_name)
+
     # file is compressed
     else:
-        unzipped_file_name = file_name[:-len('.gz')]
 
         # extracted local copy found
         if os.path.isfile(path + unzipped_file_name):
@@ -45,9 +89,12 @@ def download_file(project, profile, path, file_name):
                 bp.get_files_from_bucket(project, profile, path, file_name)
                 print("Extracting file: " + file_name)
                 extract_gz_file(path + file_name)
+        file_name = unzipped_file_name
 
     print('-'*80)
 
+    return file_name
+
     
 def download_gz_file_old(project, profile, path, file_name_gz):
     ''' Checks if specified .gz has an extracted version locally (ready to use).  
@@ -82,8 +129,8 @@ def download_gz_file_old(project, profile, path, file_name_gz):
     print('-'*80)
             
         
-def extract_gz_file(file_path):
-    ''' Extract a *.gz file '''
+def extract_gz_file(file_path, remove=True):
+    ''' Extract a *.gz file (and remove it, unless remove is False) '''
     
     output_path = file_path[0:(file_path.rfind('.'))]
 
@@ -92,9 +139,19 @@ def extract_gz_file(file_path):
         
     print(file_path + " extracted to " + output_path)
     
-    os.remove(file_path)
+    if remove:
+        os.remove(file_path)
     
-    print(file_path + " removed")
+        print(file_path + " removed")
+
+
+def open_vcf(full_file_name):
+    ''' Open a VCF file for reading, decompressing .gz (gzip or BGZF) files as a stream '''
+
+    if full_file_name.endswith('.gz'):
+        return io.BufferedReader(gzip.open(full_file_name, 'rb'), 1024 * 1024)
+
+    return open(full_file_name, 'rb')
 
     
 def query_somatic_mutations_by_case(project_id, case_id):
@@ -218,25 +275,25 @@ def print_VCF_files_by_case(project, case, path, file_name):
 def somatic_mutation_by_gene_and_mutation(project, profile, path, vcf_gz, gene, mutation, details = False):
     ''' Return all records in a specified VCF that contains a specified gene and mutation and the total found'''
     
-    download_file(project, profile, path, vcf_gz)
-    
-    if vcf_gz.endswith('.gz'):
-        vcf = vcf_gz[:-len('.gz')]
-    else:
-        vcf = vcf_gz
-    
-    vcf_reader = VariantFile(path + vcf, drop_samples = True)
+    # the compressed file is streamed in one pass, no extracted copy is needed
+    vcf = download_file(project, profile, path, vcf_gz, extract=False)
     
     counter = 0
 
     print("Processing file: " + vcf + "\n")
 
     # iterate through each record
-    for rec in vcf_reader.fetch():
-        if "ANN=" in str(rec):
+    with open_vcf(path + vcf) as vcf_fp:
+        for row in csv.reader(vcf_fp, delimiter='\t'):
+            if row[0].startswith('#') or len(row) < 8:
+                continue
+
+            ann_tags = [tag[len("ANN="):] for tag in row[7].split(';') if tag.startswith("ANN=")]
+            if not ann_tags:
+                continue
 
             # get list of Annotations
-            ann_list = str(rec.info["ANN"]).replace(" ", "").split(",")
+            ann_list = ann_tags[0].replace(" ", "").split(",")
 
             found = False
             
@@ -250,13 +307,13 @@ def somatic_mutation_by_gene_and_mutation(project, profile, path, vcf_gz, gene,
                         # first occurrence of a match in list of Annotations; print entire record
                         if found is False:
                             found = True
-                            print(str(rec.info["ANN"]) + "\n")
+                            print(ann_tags[0] + "\n")
                             counter += 1
                         
                         # print significant fields from record for easier visibility
                         if details is True:
                             print("* gene: %s, chromosome: %s, mutation offset: %s, nucleotide change: %s, AA change: %s\n" 
-                                  % (ann[3], rec.chrom, rec.pos, ann[9], ann[10]))
+                                  % (ann[3], row[0], row[1], ann[9], ann[10]))
     
     print('-'*80)
     print("Records found: " + str(counter))
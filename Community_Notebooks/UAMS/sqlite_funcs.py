@@ -4,6 +4,9 @@ import sqlite3
 import csv
 import os
 import sys
+import zlib
+import multiprocessing
+import Queue
 import bpa_analysis_functions_uams as ar 
 
 def create_db_tables(path, drop_if_exists=True):
@@ -22,6 +25,7 @@ def create_db_tables(path, drop_if_exists=True):
         drop_tables_str = '''
             DROP TABLE IF EXISTS annotations;
             DROP TABLE IF EXISTS vcf;
+            DROP TABLE IF EXISTS metadata_files;
             DROP TABLE IF EXISTS metadata;
         '''
 
@@ -34,11 +38,11 @@ def create_db_tables(path, drop_if_exists=True):
            CREATE TABLE vcf (
                 vcf_id INTEGER PRIMARY KEY,
                 chrom TEXT,
-                pos TEXT,
+                pos INTEGER,
                 id TEXT,
                 ref TEXT,
                 alt TEXT,
-                qual TEXT,
+                qual REAL,
                 filter TEXT,
                 info TEXT,
                 format TEXT,
@@ -75,26 +79,98 @@ def create_db_tables(path, drop_if_exists=True):
 
         conn.close()
 
+    create_metadata_files_table(db_full_location)
+    create_db_indexes(db_full_location)
+
     return db_full_location
 
 
-def import_vcf_data(db_full_location, path, vcf_file, metadata_id, import_only_pass=True):
-    """Imports data for a given VCF file into the sqlite3 DB."""
+def create_metadata_files_table(db_full_location):
+    """Creates the metadata_files table (one row per VCF of a metadata row), filling it from file_name if new."""
+
+    conn = sqlite3.connect(db_full_location)
+
+    exists = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'metadata_files'").fetchone()[0]
+    if not exists:
+        conn.executescript('''
+            CREATE TABLE metadata_files (
+                metadata_id INTEGER,
+                file_name TEXT,
+                bid TEXT,
+                FOREIGN KEY(metadata_id) REFERENCES metadata(metadata_id)
+            );
+            CREATE UNIQUE INDEX metadata_files_file_name ON metadata_files (metadata_id, file_name);
+            CREATE INDEX metadata_files_bid ON metadata_files (metadata_id, bid);
+            ''')
+
+        # DBs created before the table existed keep the file names as a csv list in metadata.file_name
+        rows = conn.execute('SELECT metadata_id, file_name FROM metadata').fetchall()
+        conn.executemany('INSERT OR IGNORE INTO metadata_files (metadata_id, file_name, bid) VALUES (?, ?, ?)',
+                         ((metadata_id, f, get_bid(f)) for metadata_id, file_names in rows
+                          for f in str(file_names).split(',')))
+        conn.commit()
+
+    conn.close()
+
+
+def create_db_indexes(db_full_location):
+    """Creates the indexes used by the mutation lookups (if they do not exist yet)."""
 
-    # connect to DB
     conn = sqlite3.connect(db_full_location)
 
+    conn.executescript('''
+        CREATE INDEX IF NOT EXISTS vcf_chrom_pos ON vcf (chrom, pos);
+        CREATE INDEX IF NOT EXISTS vcf_metadata_id ON vcf (metadata_id);
+        CREATE INDEX IF NOT EXISTS annotations_gene_aa ON annotations (gene_symbol, amino_acid_change);
+        CREATE INDEX IF NOT EXISTS annotations_vcf_id ON annotations (vcf_id);
+        CREATE INDEX IF NOT EXISTS metadata_case ON metadata (case_name, case_id, experimental_strategy);
+        ''')
+    conn.commit()
+
+    conn.close()
+
+
+def import_vcf_data(db_full_location, path, vcf_file, metadata_id, import_only_pass=True, chunk_size=10000,
+                    journal_mode='WAL', synchronous='NORMAL'):
+    """Imports data for a given VCF (or .vcf.gz) file into the sqlite3 DB, inserting chunk_size rows per transaction."""
+
+    # connect to DB
+    conn = connect_db(db_full_location, journal_mode, synchronous)
+
     full_file_name = path + vcf_file
     
     print('\nOpening: ' + full_file_name)
-    with open(full_file_name, 'rb') as vcf_fp:  # open vcf_file
+    print('Importing: ' + vcf_file)
+    file_row_count = 0
+    insert_row_count = 0
+    try:
+        for vcf_rows, annotation_rows in read_vcf_batches(full_file_name, metadata_id, import_only_pass, chunk_size):
+            file_row_count += len(vcf_rows)
+            print('Total File Records Read: ' + str(file_row_count) + '\r'),
+            sys.stdout.flush()
+            insert_row_count += insert_vcf_chunk(conn, vcf_rows, annotation_rows)[1]
+    except ValueError as e:
+        print('ERROR: ' + str(e) + ' Exiting.')
+        sys.exit(1)
+
+    print('Imported: ' + vcf_file + ' | Total File Records in File : ' + str(file_row_count) +
+          ' | Total Rows Inserted: ' + str(insert_row_count))
+
+    if file_row_count != insert_row_count:
+        print('ERROR: Rows in file did not equal rows inserted.')
+
+    conn.close()
+
+
+def read_vcf_batches(full_file_name, metadata_id, import_only_pass=True, batch_size=10000):
+    """Yields the parsed rows of a VCF file as batches of (vcf rows, (batch position, annotation) rows)."""
+
+    with ar.open_vcf(full_file_name) as vcf_fp:  # open vcf_file
         vcf_reader = csv.reader(vcf_fp, delimiter='\t')  # create csv reader
 
-        print('Importing: ' + vcf_file)
-        file_row_count = 0
-        insert_row_count = 0
+        vcf_rows = []
+        annotation_rows = []
         # advance to first record (skipping header info)
-        # and insert rows of data into vcf table
         for row in vcf_reader:
             if '#' == row[0][0]:
                 continue
@@ -102,19 +178,204 @@ def import_vcf_data(db_full_location, path, vcf_file, metadata_id, import_only_p
             if row[6] != 'PASS' and import_only_pass:
                 continue
 
-            file_row_count += 1
-            if file_row_count % 50 == 0:
-                print('Total File Records Read: ' + str(file_row_count) + '\r'),
-                sys.stdout.flush()
-            insert_row_count += insert_vcf_row(conn, row, metadata_id)
+            vcf_row, annotations = parse_vcf_row(row, metadata_id)
 
-    print('Imported: ' + vcf_file + ' | Total File Records in File : ' + str(file_row_count) +
-          ' | Total Rows Inserted: ' + str(insert_row_count))
+            # annotations are linked to their vcf row by its position in the batch
+            annotation_rows.extend((len(vcf_rows), annotation) for annotation in annotations)
+            vcf_rows.append(vcf_row)
+            if len(vcf_rows) >= batch_size:
+                yield vcf_rows, annotation_rows
+                vcf_rows = []
+                annotation_rows = []
 
-    if file_row_count != insert_row_count:
-        print('ERROR: Rows in file did not equal rows inserted.')
+        if vcf_rows:
+            yield vcf_rows, annotation_rows
 
-    conn.close()
+
+def connect_db(db_full_location, journal_mode='WAL', synchronous='NORMAL'):
+    """Connects to the sqlite3 DB for bulk writes with explicit transactions and the given pragmas."""
+
+    conn = sqlite3.connect(db_full_location)
+    conn.isolation_level = None  # transactions are started and committed by insert_vcf_chunk
+
+    if journal_mode:
+        conn.execute('PRAGMA journal_mode = ' + journal_mode)
+    if synchronous:
+        conn.execute('PRAGMA synchronous = ' + synchronous)
+
+    return conn
+
+
+def parse_vcf_row(row, metadata_id):
+    """Returns the vcf table values and the snpEff annotations of one row of VCF data."""
+
+    params = [item for item in row if item.strip() != '']
+    if len(params) > 5:
+        params[1] = to_number(params[1], int)  # pos
+        params[5] = to_number(params[5], float)  # qual
+    params = tuple(params)
+
+    if len(params) == 11:  # has two sample normal and tumor (IN THAT ORDER)
+        vcf_row = params[:10] + (to_number(get_tag_value("DP", row[8], row[9]), int),
+                                 to_number(get_tag_value("AF", row[8], row[9]), float),
+                                 params[10], to_number(get_tag_value("DP", row[8], row[10]), int),
+                                 to_number(get_tag_value("AF", row[8], row[10]), float), metadata_id)
+    elif len(params) == 10:  # has only one sample (the tumor only)
+        vcf_row = params[:9] + (None, None, None,
+                                params[9], to_number(get_tag_value("DP", row[8], row[9]), int),
+                                to_number(get_tag_value("AF", row[8], row[9]), float), metadata_id)
+    else:
+        raise ValueError('An unexpected number of columns were found in the vcf file.')
+
+    # snpEff annotations found in the ANN tag of the INFO column
+    annotations = []
+    for tag in row[7].split(';'):
+        if tag.startswith("ANN="):
+            for effect in tag[4:].split(','):
+                annotation_row = effect.split('|')
+                if len(annotation_row) >= 10:  # corner case where there was not enough columns
+                    annotations.append((annotation_row[4], annotation_row[1], annotation_row[2],
+                                        annotation_row[10], annotation_row[3], annotation_row[9]))
+
+    return vcf_row, annotations
+
+
+def insert_vcf_chunk(conn, vcf_rows, annotation_rows):
+    """Inserts parsed vcf rows and their (chunk position, annotation) rows in one transaction, returning the
+    first vcf_id it assigned and the number of rows inserted."""
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # vcf_ids are assigned here, so annotations do not need the lastrowid of each insert
+        first_vcf_id = conn.execute('SELECT COALESCE(MAX(vcf_id), 0) + 1 FROM vcf').fetchone()[0]
+
+        conn.executemany('INSERT INTO vcf '
+                         '(vcf_id, chrom, pos, id, ref, alt, qual, filter, info, format, '
+                         'normal, normal_dp, normal_af, tumor, tumor_dp, tumor_af, metadata_id) '
+                         'VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         ((first_vcf_id + i, ) + vcf_row for i, vcf_row in enumerate(vcf_rows)))
+
+        conn.executemany('INSERT INTO annotations '
+                         '(ensembl_gene_id, effect, effect_impact, amino_acid_change, '
+                         'gene_symbol, dna, vcf_id) '
+                         'VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?)',
+                         (annotation + (first_vcf_id + i, ) for i, annotation in annotation_rows))
+
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        conn.execute('ROLLBACK')
+        raise
+
+    return first_vcf_id, len(vcf_rows)
+
+
+def discard_vcf_import(conn, vcf_id_ranges, metadata_id, vcf_file):
+    """Deletes the vcf rows (and their annotations) in the given (first vcf_id, row count) ranges and unregisters
+    the file from its metadata row, removing the row if no other file uses it, so the file can be imported again."""
+
+    conn.execute('BEGIN IMMEDIATE')
+    for first_vcf_id, count in vcf_id_ranges:
+        conn.execute('DELETE FROM annotations WHERE vcf_id BETWEEN ? AND ?', (first_vcf_id, first_vcf_id + count - 1))
+        conn.execute('DELETE FROM vcf WHERE vcf_id BETWEEN ? AND ?', (first_vcf_id, first_vcf_id + count - 1))
+
+    # the file was registered under its downloaded (compressed) name
+    conn.execute('DELETE FROM metadata_files WHERE metadata_id = ? AND file_name IN (?, ?)',
+                 (metadata_id, vcf_file, vcf_file + '.gz'))
+    if conn.execute('SELECT COUNT(*) FROM metadata_files WHERE metadata_id = ?', (metadata_id, )).fetchone()[0]:
+        conn.execute('UPDATE metadata '
+                     'SET file_name = (SELECT group_concat(file_name) FROM '
+                     '(SELECT file_name FROM metadata_files WHERE metadata_id = ? ORDER BY rowid)) '
+                     'WHERE metadata_id = ?', (metadata_id, metadata_id))
+    elif not conn.execute('SELECT COUNT(*) FROM vcf WHERE metadata_id = ?', (metadata_id, )).fetchone()[0]:
+        conn.execute('DELETE FROM metadata WHERE metadata_id = ?', (metadata_id, ))
+    conn.execute('COMMIT')
+
+
+def parse_vcf_files(tasks, batches, import_only_pass, batch_size):
+    """Parser process: turns each (full file name, metadata_id) task into row batches put on the bounded queue."""
+
+    for full_file_name, metadata_id in iter(tasks.get, None):
+        try:
+            for vcf_rows, annotation_rows in read_vcf_batches(full_file_name, metadata_id, import_only_pass,
+                                                              batch_size):
+                # blocks while the writer is behind, so parsed rows never pile up in memory
+                batches.put(('rows', full_file_name, vcf_rows, annotation_rows))
+            batches.put(('done', full_file_name, None, None))
+        except (IOError, OSError, ValueError, IndexError, csv.Error, zlib.error) as e:
+            batches.put(('error', full_file_name, '%s: %s' % (type(e).__name__, e), None))
+
+
+def import_vcfs_sqlite(db_full_location, vcf_files, workers=None, import_only_pass=True, batch_size=10000,
+                       queue_size=8, journal_mode='WAL', synchronous='NORMAL'):
+    """Imports several (path, vcf_file, metadata_id) VCFs with a pool of parser processes and a single DB writer.
+
+    Returns a dictionary of vcf_file to the number of rows inserted, or to the error that stopped its import
+    (the rows and metadata registration of a failed file are removed again, so it can be re-imported)."""
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(vcf_files)))
+
+    tasks = multiprocessing.Queue()
+    batches = multiprocessing.Queue(queue_size)
+    names = {}
+    metadata_ids = {}
+    for path, vcf_file, metadata_id in vcf_files:
+        names[path + vcf_file] = vcf_file
+        metadata_ids[path + vcf_file] = metadata_id
+        tasks.put((path + vcf_file, metadata_id))
+    for _ in range(workers):
+        tasks.put(None)
+
+    parsers = [multiprocessing.Process(target=parse_vcf_files, args=(tasks, batches, import_only_pass, batch_size))
+               for _ in range(workers)]
+    for parser in parsers:
+        parser.daemon = True
+        parser.start()
+
+    # this process is the only writer, inserting each batch in its own transaction
+    conn = connect_db(db_full_location, journal_mode, synchronous)
+    results = {}
+    inserted = dict((full_file_name, []) for full_file_name in names)
+    pending = len(names)
+    try:
+        while pending:
+            try:
+                status, full_file_name, payload, annotation_rows = batches.get(timeout=1)
+            except Queue.Empty:
+                if not any(parser.is_alive() for parser in parsers):
+                    break
+                continue
+
+            vcf_file = names[full_file_name]
+            if status == 'rows':
+                inserted[full_file_name].append(insert_vcf_chunk(conn, payload, annotation_rows))
+                continue
+
+            pending -= 1
+            if status == 'done':
+                results[vcf_file] = sum(count for first_vcf_id, count in inserted[full_file_name])
+                print('Imported: ' + vcf_file + ' | Total Rows Inserted: ' + str(results[vcf_file]))
+            else:
+                discard_vcf_import(conn, inserted[full_file_name], metadata_ids[full_file_name], vcf_file)
+                results[vcf_file] = payload
+                print('ERROR: ' + vcf_file + ' was not imported (' + payload + ').')
+
+        for full_file_name, vcf_file in names.items():
+            if vcf_file not in results:
+                discard_vcf_import(conn, inserted[full_file_name], metadata_ids[full_file_name], vcf_file)
+                results[vcf_file] = 'parser process exited'
+                print('ERROR: ' + vcf_file + ' was not imported (parser process exited).')
+    finally:
+        conn.close()
+        for parser in parsers:
+            parser.join(1)
+            if parser.is_alive():
+                parser.terminate()
+
+    return results
 
 
 def insert_vcf_row(conn, row, metadata_id):
@@ -200,85 +461,96 @@ def insert_metadata_row(db_full_location, case_name, case_id, experimental_strat
     # connect to DB
     conn = sqlite3.connect(db_full_location)
 
-    cursor = conn.cursor()
+    metadata_id = register_metadata_file(conn, case_name, case_id, experimental_strategy, file_name)
+    conn.commit()
 
-    # verify that this data has not already been imported by checking for matches in metadata table
-    cursor.execute('SELECT metadata_id, case_name, case_id, experimental_strategy, file_name '
-                   'FROM metadata '
-                   'WHERE case_name = ? '
-                   'AND case_id = ? '
-                   'AND experimental_strategy = ? ', 
-                   (case_name, case_id, experimental_strategy))
-    
-    rows = cursor.fetchall()
-    
-    # no match on case_name, case_id, experimental_strategy
-    if len(rows) == 0:
-        
-        cursor.execute('INSERT INTO metadata '
-                       '(case_name, case_id, experimental_strategy, file_name) '
-                       'VALUES (?, ?, ?, ?)', (case_name, case_id, experimental_strategy, file_name))
-        conn.commit()
+    conn.close()
+
+    return metadata_id
+
+
+def insert_metadata_rows(db_full_location, metadata_rows):
+    """Inserts (case_name, case_id, experimental_strategy, file_name) metadata rows in one transaction,
+    returning their metadata_ids (-1 for files already imported)."""
+
+    conn = sqlite3.connect(db_full_location)
+
+    metadata_ids = [register_metadata_file(conn, *metadata_row) for metadata_row in metadata_rows]
+    conn.commit()
+
+    conn.close()
+
+    return metadata_ids
+
+
+def register_metadata_file(conn, case_name, case_id, experimental_strategy, file_name):
+    """Adds a file to the metadata row of the same case, experimental strategy and BID, or to a new row.
+    Returns its metadata_id, or -1 if the file was already imported. The caller commits."""
+
+    cursor = conn.cursor()
 
-        print("Row inserted into metadata table.")
-        
-        return cursor.lastrowid
-        
     # BID in the file name indicates files belong to the same study.
-    # Parse the file_name field (csv list of file names) to see if any file's BID matches the
-    # BID of the file the user is attempting to import; if so we will append this file to the csv
+    file_name_bid = get_bid(file_name)
+
+    # one indexed lookup for this file, or another file with the same BID, among the rows of this case
+    cursor.execute('SELECT m.metadata_id, f.file_name = ? '
+                   'FROM metadata m '
+                   'JOIN metadata_files f ON f.metadata_id = m.metadata_id '
+                   'WHERE m.case_name = ? '
+                   'AND m.case_id = ? '
+                   'AND m.experimental_strategy = ? '
+                   'AND (f.file_name = ? OR f.bid = ?) '
+                   'ORDER BY 2 DESC, m.metadata_id '
+                   'LIMIT 1',
+                   (file_name, case_name, case_id, experimental_strategy, file_name, file_name_bid))
+    match = cursor.fetchone()
+
+    # file already exists, abort
+    if match is not None and match[1]:
+        print("File already imported.  Abort insert to metadata table.")
+        return -1
+
+    # file found with a matching BID, add this file to its metadata row
+    if match is not None:
+        metadata_id = match[0]
+        cursor.execute('UPDATE metadata '
+                       'SET file_name = file_name || ? '
+                       'WHERE metadata_id = ? ', ("," + file_name, metadata_id))
+        print("Metadata table row " + str(metadata_id) + " updated.")
+
+    # no matches found from rows with the same case and experimental strategy with the same BID
+    # insert a new record
     else:
-        # get BID from file_name
-        #file_name_substring = file_name.split("BID-", 1)[1]
-        #file_name_bid = file_name_substring.split("-", 1)[0]
-        
-        file_name_bid = (file_name.split("BID-", 1)[1]).split("-", 1)[0]
-        
-        for row in rows:
-
-            file_list = str(row[4]).split(",")
-            
-            # file already exists, abort
-            if file_name in file_list:
-                print("File already imported.  Abort insert to metadata table.")
-                return -1            
-          
-            else:
-                for f in file_list:
-                    
-                    #f_substring = f.split("BID-", 1)[1]
-                    #f_bid = f_substring.split("-", 1)[0]
-                    
-                    f_bid = (f.split("BID-", 1)[1]).split("-", 1)[0]
-
-                    # file found with a matching BID , append this file_name 
-                    # to the file_name column as csv 
-                    if file_name_bid == f_bid:    
-                        updated_file_name = row[4] + "," + file_name
-
-                        cursor.execute('UPDATE metadata '
-                                       'SET file_name = ? '
-                                       'WHERE metadata_id = ? ', (updated_file_name, row[0]))
-
-                        conn.commit()
-
-                        print("Metadata table row " + str(row[0]) + " updated.")
-
-                        return row[0]
-          
-            # no matches found from rows with the same case and experimental strategy with the same BID
-            # insert a new record
-            cursor.execute('INSERT INTO metadata '
+        cursor.execute('INSERT INTO metadata '
                        '(case_name, case_id, experimental_strategy, file_name) '
                        'VALUES (?, ?, ?, ?)', (case_name, case_id, experimental_strategy, file_name))
-                               
-            conn.commit()
+        metadata_id = cursor.lastrowid
+        print("Row inserted into metadata table.")
+
+    cursor.execute('INSERT INTO metadata_files (metadata_id, file_name, bid) VALUES (?, ?, ?)',
+                   (metadata_id, file_name, file_name_bid))
+
+    return metadata_id
+
+
+def get_bid(file_name):
+    """Returns the BID in a file name (the text between "BID-" and the next "-"), or None."""
+
+    if "BID-" not in file_name:
+        return None
+
+    return (file_name.split("BID-", 1)[1]).split("-", 1)[0]
+
+
+def to_number(value, number_type):
+    """Returns the value converted to number_type, or unchanged if it is missing or not a single number."""
+
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return value
+
 
-            print("Row inserted into metadata table.")
-            
-            return cursor.lastrowid
-        
-        
 def get_tag_value(tag_string, format_string, sample_string):
     """Returns the value of the tag in a given sample."""
     split_format_string = format_string.split(':')
@@ -300,18 +572,115 @@ def get_tag_value(tag_string, format_string, sample_string):
         return None
         
         
-def import_case_sqlite(db_full_location, project, profile, path, case_dict, case):
+def register_case_vcfs(db_full_location, project, profile, path, case_dict, case, case_vcfs=None):
+    """Inserts the metadata rows of a case's Panel VCFs and downloads them, returning the files to import."""
+
     case_id = case_dict.get(case)
-    case_vcfs = ar.dict_VCF_files_by_case(project, case)
+    if case_vcfs is None:
+        case_vcfs = ar.dict_VCF_files_by_case(project, case)
+
+    # the metadata rows of the whole case are registered in one transaction
+    panel_vcfs = [vcf for vcf, strategy in case_vcfs.items() if strategy == 'Panel'] # or strategy == 'Total RNA'
+    metadata_ids = insert_metadata_rows(db_full_location, [(case, case_id, 'Panel', vcf) for vcf in panel_vcfs])
+
+    vcf_files = []
+    for vcf, metadata_id in zip(panel_vcfs, metadata_ids):
+        if metadata_id >= 0:
+            # compressed VCFs are imported as they are, without an extracted copy
+            local_file_name = ar.download_file(project, profile, path, vcf, extract=False)
+            vcf_files.append((path, local_file_name, metadata_id))
+        else:
+              print("File already imported.  Abort insert to vcf & annotations table.")
 
-    for vcf, strategy in case_vcfs.items():
-        if strategy == 'Panel': # or strategy == 'Total RNA':
-            metadata_id = insert_metadata_row(db_full_location, case, case_id, strategy, vcf)
+    return vcf_files
 
-            if metadata_id >= 0:
-                ar.download_file(project, profile, path, vcf)
-                extracted_file_name = vcf[:-len('.gz')]
-                import_vcf_data(db_full_location, path, extracted_file_name, metadata_id)
-            else:
-                  print("File already imported.  Abort insert to vcf & annotations table.")
-            
\ No newline at end of file
+
+def import_case_sqlite(db_full_location, project, profile, path, case_dict, case, case_vcfs=None, workers=None):
+    """Imports the Panel VCFs of a case, parsing them in worker processes if workers is given."""
+
+    vcf_files = register_case_vcfs(db_full_location, project, profile, path, case_dict, case, case_vcfs)
+
+    if workers:
+        return import_vcfs_sqlite(db_full_location, vcf_files, workers)
+
+    for path, vcf_file, metadata_id in vcf_files:
+        import_vcf_data(db_full_location, path, vcf_file, metadata_id)
+
+
+def import_cases_sqlite(db_full_location, project, profile, path, case_dict, cases=None, workers=None):
+    """Imports several cases, querying their VCF lists from the API in parallel before importing them in order.
+
+    With workers, the VCFs of all the cases are parsed by one pool of processes feeding a single DB writer."""
+
+    if cases is None:
+        cases = list(case_dict.keys())
+
+    all_case_vcfs = ar.bp.executor.map(ar.dict_VCF_files_by_case, [(project, case) for case in cases])
+
+    if workers:
+        vcf_files = []
+        for case, case_vcfs in zip(cases, all_case_vcfs):
+            vcf_files += register_case_vcfs(db_full_location, project, profile, path, case_dict, case, case_vcfs)
+        return import_vcfs_sqlite(db_full_location, vcf_files, workers)
+
+    for case, case_vcfs in zip(cases, all_case_vcfs):
+        import_case_sqlite(db_full_location, project, profile, path, case_dict, case, case_vcfs)
+
+
+mutation_columns = ('case_name', 'case_id', 'experimental_strategy', 'chrom', 'pos', 'ref', 'alt',
+                    'gene_symbol', 'amino_acid_change', 'dna', 'effect', 'effect_impact',
+                    'normal_dp', 'normal_af', 'tumor_dp', 'tumor_af', 'vcf_id')
+
+
+def find_mutations(db_full_location, gene=None, aa_change=None, case=None, chrom=None, pos=None,
+                   experimental_strategy=None):
+    """Returns the annotated mutations in the DB matching every given criterion, as a list of dictionaries."""
+
+    conditions = []
+    params = ()
+    for column, value in (('a.gene_symbol', gene), ('a.amino_acid_change', aa_change), ('m.case_name', case),
+                          ('v.chrom', chrom), ('v.pos', pos), ('m.experimental_strategy', experimental_strategy)):
+        if value is not None:
+            conditions.append(column + ' = ?')
+            params = params + (value, )
+
+    query = ('SELECT m.case_name, m.case_id, m.experimental_strategy, v.chrom, v.pos, v.ref, v.alt, '
+             'a.gene_symbol, a.amino_acid_change, a.dna, a.effect, a.effect_impact, '
+             'v.normal_dp, v.normal_af, v.tumor_dp, v.tumor_af, v.vcf_id '
+             'FROM annotations a '
+             'JOIN vcf v ON v.vcf_id = a.vcf_id '
+             'JOIN metadata m ON m.metadata_id = v.metadata_id ')
+    if conditions:
+        query += 'WHERE ' + ' AND '.join(conditions) + ' '
+    query += 'ORDER BY m.case_name, v.chrom, v.pos'
+
+    conn = sqlite3.connect(db_full_location)
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+
+    return [dict(zip(mutation_columns, row)) for row in rows]
+
+
+def mutation_frequency_by_gene(db_full_location, case=None, experimental_strategy=None):
+    """Returns (gene_symbol, mutations, cases) tuples counting the distinct mutated records and cases per gene."""
+
+    conditions = []
+    params = ()
+    for column, value in (('m.case_name', case), ('m.experimental_strategy', experimental_strategy)):
+        if value is not None:
+            conditions.append(column + ' = ?')
+            params = params + (value, )
+
+    query = ('SELECT a.gene_symbol, COUNT(DISTINCT a.vcf_id), COUNT(DISTINCT m.case_name) '
+             'FROM annotations a '
+             'JOIN vcf v ON v.vcf_id = a.vcf_id '
+             'JOIN metadata m ON m.metadata_id = v.metadata_id ')
+    if conditions:
+        query += 'WHERE ' + ' AND '.join(conditions) + ' '
+    query += 'GROUP BY a.gene_symbol ORDER BY 2 DESC, a.gene_symbol'
+
+    conn = sqlite3.connect(db_full_location)
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+
+    return rows
@@ -0,0 +1,123 @@
+''' Check the API client against the local stand-in of the data commons
+
+Covers reusing the persisted token across add_keys calls, refreshing it shortly before it expires,
+forcing a refresh when the API rejects it, and keeping pool_size connections alive.
+
+Usage:
+    python benchmarks/check_api_client.py
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..'))
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import bpa_analysis_functions_v2 as bp
+import graphql_server
+import synthetic_data
+
+failures = []
+
+
+def check(description, condition):
+    ''' Print the outcome of one check and remember failures '''
+
+    print('%s - %s' % ('ok' if condition else 'FAIL', description))
+    if not condition:
+        failures.append(description)
+
+
+def query(project_id):
+    ''' One small authenticated GraphQL request '''
+
+    return json.loads(bp.client.post({'query': '{ sample(first: 1, project_id: "%s") { submitter_id } }' % project_id}))
+
+
+def main():
+    work_path = tempfile.mkdtemp(prefix='bpa-client-')
+    project_id = 'bpa-CLIENT'
+    pool_size = 4
+
+    try:
+        graph, _ = synthetic_data.build_project(work_path, project_id, 2, 1, 10, 2)
+        server = graphql_server.serve(graph, latency=0.05)
+        bp.client.url = 'http://127.0.0.1:%d/' % server.server_port
+        keys_path = os.path.join(work_path, 'credentials.json')
+        with open(keys_path, 'w') as f:
+            json.dump({'api_key': 'check', 'key_id': 'check'}, f)
+
+        # token reuse: the token persisted by the first add_keys serves the second one and every query
+        bp.add_keys(keys_path)
+        token = bp.client.access_token
+        bp.add_keys(keys_path)
+        for _ in range(3):
+            query(project_id)
+        check('add_keys twice and three queries request one token', server.stats['token'] == 1)
+        check('add_keys reuses the persisted token', bp.client.access_token == token)
+        check('the token is persisted next to the keys', os.path.exists(keys_path + '.token'))
+
+        # refresh near expiry: a token lapsing within refresh_margin is replaced before it is sent
+        margin = bp.client.refresh_margin
+        server.token_lifetime = margin + 2
+        bp.client.get_token(force=True)
+        tokens_before = server.stats['token']
+        query(project_id)
+        check('a token outside refresh_margin is reused', server.stats['token'] == tokens_before)
+        time.sleep(3)
+        response = query(project_id)
+        check('a token inside refresh_margin is refreshed before the query',
+              server.stats['token'] == tokens_before + 1 and 'errors' not in response)
+        server.token_lifetime = 3600
+        bp.client.get_token(force=True)
+
+        # forced refresh on 401: a token revoked by the server is replaced and the query retried once
+        revoked = bp.client.access_token
+        del server.tokens[revoked]
+        tokens_before = server.stats['token']
+        requests_before = server.stats['graphql']
+        response = query(project_id)
+        check('a rejected token is refreshed and the query retried',
+              server.stats['token'] == tokens_before + 1 and server.stats['graphql'] == requests_before + 2)
+        check('the retried query succeeds', response['data']['sample'] != [])
+        check('the refreshed token replaces the revoked one', bp.client.access_token != revoked)
+
+        # pool sizing: pool_size concurrent queries open pool_size connections that the next ones reuse
+        bp.add_keys(keys_path, pool_size=pool_size)
+        adapter = bp.client.session.get_adapter(bp.client.url)
+        check('add_keys sizes the connection pool', adapter._pool_maxsize == pool_size)
+        executor = ThreadPool(pool_size)
+        connections_before = server.stats['connections']
+        executor.map(lambda _: query(project_id), range(pool_size))
+        opened = server.stats['connections'] - connections_before
+        check('%d concurrent queries open at most %d connections (opened %d)' % (pool_size, pool_size, opened),
+              opened <= pool_size)
+        connections_before = server.stats['connections']
+        executor.map(lambda _: query(project_id), range(pool_size * 3))
+        check('later queries reuse the pooled connections', server.stats['connections'] == connections_before)
+        executor.close()
+
+        bp.client.session.close()
+        server.shutdown()
+        server.server_close()
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    if failures:
+        print('%d check(s) failed' % len(failures))
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
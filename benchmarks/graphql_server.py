@@ -0,0 +1,360 @@
+''' Local stand-in for the data commons token and GraphQL endpoints serving a synthetic project '''
+
+import base64
+import json
+import re
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+# child node type -> (link name on the child, parent node type, backref name on the parent)
+links = [
+    ('sample', 'cases', 'case', 'samples'),
+    ('diagnosis', 'cases', 'case', 'diagnoses'),
+    ('aliquot', 'samples', 'sample', 'aliquots'),
+    ('analyte', 'aliquots', 'aliquot', 'analytes'),
+    ('read_group', 'analytes', 'analyte', 'read_groups'),
+    ('submitted_somatic_mutation', 'read_groups', 'read_group', 'submitted_somatic_mutations'),
+    ('submitted_unaligned_reads', 'read_groups', 'read_group', 'submitted_unaligned_reads_files'),
+    ('submitted_aligned_reads', 'read_groups', 'read_group', 'submitted_aligned_reads_files'),
+    ('submitted_copy_number', 'read_groups', 'read_group', 'submitted_copy_number_files'),
+    ('contrived_expectation', 'aliquots', 'aliquot', 'contrived_expectations'),
+    ('experiment_metadata', 'experiments', 'experiment', 'experiment_metadata_files'),
+]
+
+token_pattern = re.compile(r'\s*(?:(#[^\n]*)|("(?:[^"\\]|\\.)*")|(-?\d+(?:\.\d+)?)|([A-Za-z_][A-Za-z0-9_]*)|([{}()\[\]:,!$]))')
+
+
+class Graph(object):
+    ''' In-memory graph of nodes with parent/child links '''
+
+    def __init__(self):
+        self.nodes = {}
+        self.by_type = {}
+        self.parents = {}
+        self.children = {}
+        self.counter = 0
+
+    def add(self, node_type, parent=None, **properties):
+        self.counter += 1
+        node = dict(properties)
+        node.setdefault('id', '%s-%08d' % (node_type, self.counter))
+        node.setdefault('updated_datetime', '2018-01-01T00:00:00')
+        node['type'] = node_type
+        self.nodes[node['id']] = node
+        self.by_type.setdefault(node_type, []).append(node)
+        self.parents[node['id']] = []
+        self.children[node['id']] = []
+        if parent is not None:
+            self.link(node, parent)
+
+        return node
+
+    def link(self, child, parent):
+        self.parents[child['id']].append(parent['id'])
+        self.children[parent['id']].append(child['id'])
+
+    def related(self, node, link_name):
+        ''' Nodes reached from one node through a link or backref name '''
+
+        for child_type, child_link, parent_type, backref in links:
+            if node['type'] == child_type and link_name == child_link:
+                return [self.nodes[i] for i in self.parents[node['id']] if self.nodes[i]['type'] == parent_type]
+            if node['type'] == parent_type and link_name == backref:
+                return [self.nodes[i] for i in self.children[node['id']] if self.nodes[i]['type'] == child_type]
+
+        return None
+
+    def walk(self, node, direction):
+        seen = set()
+        stack = [node['id']]
+        while stack:
+            for i in direction[stack.pop()]:
+                if i not in seen:
+                    seen.add(i)
+                    stack.append(i)
+                    yield self.nodes[i]
+
+    def type_path(self, source_type, target_type):
+        ''' Shortest chain of node types linking two types, in either direction, like the dictionary traversal '''
+
+        previous = {source_type: None}
+        queue = [source_type]
+        while queue:
+            current = queue.pop(0)
+            if current == target_type:
+                chain = []
+                while current != source_type:
+                    chain.insert(0, current)
+                    current = previous[current]
+                return chain
+            for child_type, _, parent_type, _ in links:
+                for a, b in ((child_type, parent_type), (parent_type, child_type)):
+                    if a == current and b not in previous:
+                        previous[b] = current
+                        queue.append(b)
+
+        return None
+
+    def has_path_to(self, node, path):
+        ''' True if a node reached from node along its ancestors, its descendants or the shortest
+        chain of linked types matches the with_path_to filter '''
+
+        path = dict(path)
+        node_type = path.pop('type')
+        matches = lambda other: other['type'] == node_type and all(other.get(k) == v for k, v in path.items())
+        for direction in (self.parents, self.children):
+            if any(matches(other) for other in self.walk(node, direction)):
+                return True
+
+        # paths through a shared ancestor, e.g. contrived_expectation -> aliquot -> ... -> submitted_somatic_mutation
+        chain = self.type_path(node['type'], node_type) or []
+        frontier = [node] if chain else []
+        for step_type in chain:
+            frontier = dict((i, self.nodes[i]) for n in frontier for i in self.parents[n['id']] + self.children[n['id']]
+                            if self.nodes[i]['type'] == step_type).values()
+
+        return any(matches(other) for other in frontier)
+
+
+class Parser(object):
+    ''' Parser for the subset of GraphQL used by the analysis functions '''
+
+    def __init__(self, text):
+        self.tokens = []
+        position = 0
+        text = text.strip()
+        while position < len(text):
+            match = token_pattern.match(text, position)
+            if not match:
+                raise ValueError('Unexpected character at %d' % position)
+            position = match.end()
+            comment, string, number, name, punct = match.groups()
+            if string is not None:
+                self.tokens.append(('value', json.loads(string)))
+            elif number is not None:
+                self.tokens.append(('value', float(number) if '.' in number else int(number)))
+            elif name is not None:
+                if name in ('true', 'false', 'null'):
+                    self.tokens.append(('value', {'true': True, 'false': False, 'null': None}[name]))
+                else:
+                    self.tokens.append(('name', name))
+            elif punct is not None:
+                self.tokens.append(('punct', punct))
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, punct):
+        token = self.next()
+        if token != ('punct', punct):
+            raise ValueError('Expected %s, found %s' % (punct, token[1]))
+
+    def document(self):
+        if self.peek() == ('name', 'query'):
+            self.next()
+            if self.peek()[0] == 'name':
+                self.next()
+        return self.selection_set()
+
+    def selection_set(self):
+        self.expect('{')
+        fields = []
+        while self.peek() != ('punct', '}'):
+            if self.peek() == ('punct', ','):
+                self.next()
+                continue
+            fields.append(self.field())
+        self.expect('}')
+        return fields
+
+    def field(self):
+        kind, name = self.next()
+        if kind != 'name':
+            raise ValueError('Expected a field name, found %s' % name)
+        alias = name
+        if self.peek() == ('punct', ':'):
+            self.next()
+            name = self.next()[1]
+        args = {}
+        if self.peek() == ('punct', '('):
+            self.next()
+            args = self.arguments(')')
+        selections = None
+        if self.peek() == ('punct', '{'):
+            selections = self.selection_set()
+        return alias, name, args, selections
+
+    def arguments(self, end):
+        args = {}
+        while self.peek() != ('punct', end):
+            if self.peek() == ('punct', ','):
+                self.next()
+                continue
+            name = self.next()[1]
+            self.expect(':')
+            args[name] = self.value()
+        self.expect(end)
+        return args
+
+    def value(self):
+        kind, token = self.next()
+        if kind == 'value':
+            return token
+        if token == '[':
+            values = []
+            while self.peek() != ('punct', ']'):
+                if self.peek() == ('punct', ','):
+                    self.next()
+                    continue
+                values.append(self.value())
+            self.expect(']')
+            return values
+        if token == '{':
+            return self.arguments('}')
+        raise ValueError('Unexpected %s' % token)
+
+
+def select(graph, nodes, args):
+    ''' Apply id/submitter_id/project_id/with_path_to/offset/first filters to a node list '''
+
+    for key, value in args.items():
+        if key in ('first', 'offset'):
+            continue
+        if key == 'with_path_to':
+            for path in (value if isinstance(value, list) else [value]):
+                nodes = [n for n in nodes if graph.has_path_to(n, path)]
+        elif isinstance(value, list):
+            nodes = [n for n in nodes if n.get(key) in value]
+        else:
+            nodes = [n for n in nodes if n.get(key) == value]
+
+    offset = args.get('offset', 0)
+    first = args.get('first', 10)
+    if first:
+        return nodes[offset:offset + first]
+    return nodes[offset:]
+
+
+def resolve(graph, node, selections):
+    result = {}
+    for alias, name, args, children in selections:
+        if name.startswith('_') and name.endswith('_count'):
+            related = graph.related(node, name[1:-len('_count')])
+            result[alias] = len(select(graph, related or [], dict(args, first=0)))
+            continue
+        related = graph.related(node, name)
+        if related is not None:
+            result[alias] = [resolve(graph, n, children or []) for n in select(graph, related, args)]
+        else:
+            result[alias] = node.get(name)
+    return result
+
+
+def execute(graph, query_txt):
+    ''' Run a query against the graph and return the GraphQL response dictionary '''
+
+    try:
+        selections = Parser(query_txt).document()
+    except (ValueError, IndexError, TypeError) as e:
+        return {'data': None, 'errors': ['Syntax error: %s' % e]}
+
+    data = {}
+    for alias, name, args, children in selections:
+        if name.startswith('_') and name.endswith('_count'):
+            nodes = graph.by_type.get(name[1:-len('_count')], [])
+            data[alias] = len(select(graph, nodes, dict(args, first=0)))
+        else:
+            nodes = graph.by_type.get(name, [])
+            data[alias] = [resolve(graph, n, children or []) for n in select(graph, nodes, args)]
+
+    return {'data': data}
+
+
+def make_token(lifetime=3600, token_id=0):
+    ''' Unsigned JWT-shaped token carrying an expiration claim '''
+
+    def encode(part):
+        return base64.urlsafe_b64encode(json.dumps(part).encode('utf-8')).decode('ascii').rstrip('=')
+
+    return '%s.%s.signature' % (encode({'alg': 'none'}), encode({'exp': int(time.time()) + lifetime, 'jti': token_id}))
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(graph, port=0, latency=0.0, token_lifetime=3600):
+    ''' Start the stand-in server in a background thread and return it (server.server_port is the port)
+
+    Only unexpired tokens issued by the server are accepted; server.tokens maps them to their expiration
+    time, so deleting an entry revokes a token. server.token_lifetime applies to the next tokens issued.
+    '''
+
+    stats = {'token': 0, 'graphql': 0, 'connections': 0}
+    tokens = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            stats['connections'] += 1
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            if latency:
+                time.sleep(latency)
+            if self.path.rstrip('/').endswith('user/credentials/cdis/access_token'):
+                stats['token'] += 1
+                token = make_token(server.token_lifetime, stats['token'])
+                tokens[token] = time.time() + server.token_lifetime
+                self.reply(200, {'access_token': token})
+            elif self.path.rstrip('/').endswith('api/v0/submission/graphql'):
+                stats['graphql'] += 1
+                authorization = self.headers.get('Authorization') or ''
+                if not authorization.startswith('bearer '):
+                    self.reply(401, {'message': 'missing token'})
+                elif tokens.get(authorization[len('bearer '):], 0) < time.time():
+                    self.reply(401, {'message': 'invalid or expired token'})
+                else:
+                    self.reply(200, execute(graph, request.get('query', '')))
+            else:
+                self.reply(404, {'message': 'not found'})
+
+    server = ThreadingServer(('127.0.0.1', port), Handler)
+    server.stats = stats
+    server.tokens = tokens
+    server.token_lifetime = token_lifetime
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
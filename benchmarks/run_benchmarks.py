@@ -0,0 +1,164 @@
+''' Benchmark the analysis functions against a local stand-in of the data commons
+
+Usage:
+    python benchmarks/run_benchmarks.py --samples 50 --rounds 3 --output results.json
+    python benchmarks/run_benchmarks.py --output new.json --compare results.json
+'''
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..'))
+sys.path.insert(0, os.path.join(here, '..', 'Community_Notebooks', 'UAMS'))
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import bpa_analysis_functions_v2 as bp
+import graphql_server
+import synthetic_data
+
+
+def run_scenario(name, function, rounds, server, params):
+    ''' Time one scenario over several rounds, pytest-benchmark style '''
+
+    timings = []
+    requests_before = server.stats['graphql']
+    for _ in range(rounds):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    requests_made = (server.stats['graphql'] - requests_before) / float(rounds)
+
+    mean = sum(timings) / len(timings)
+    stddev = math.sqrt(sum((t - mean) ** 2 for t in timings) / (len(timings) - 1)) if len(timings) > 1 else 0.0
+    ordered = sorted(timings)
+    stats = {
+        'min': ordered[0],
+        'max': ordered[-1],
+        'mean': mean,
+        'median': ordered[len(ordered) // 2],
+        'stddev': stddev,
+        'rounds': rounds,
+        'data': timings
+    }
+    print('%-40s mean %9.4fs  min %9.4fs  requests/round %8.1f' % (name, mean, ordered[0], requests_made))
+
+    return {'name': name, 'params': params, 'stats': stats, 'extra_info': {'graphql_requests': requests_made}}
+
+
+def uams_import(work_path, vcf_names):
+    ''' Import annotated VCFs into a fresh UAMS SQLite database '''
+
+    import sqlite_funcs
+
+    db = sqlite_funcs.create_db_tables(work_path)
+    for i, vcf_name in enumerate(vcf_names):
+        metadata_id = sqlite_funcs.insert_metadata_row(db, 'case-%d' % i, i, 'Panel', 'BID-%d-%s' % (i, vcf_name))
+        sqlite_funcs.import_vcf_data(db, work_path + os.sep, vcf_name, metadata_id)
+
+
+def compare(results, previous_path):
+    ''' Print the speedup (previous mean / current mean) of each scenario against a previous run '''
+
+    previous = dict((b['name'], b) for b in json.load(open(previous_path))['benchmarks'])
+    print('\n%-40s %12s %12s %8s' % ('scenario', 'previous', 'current', 'speedup'))
+    for benchmark in results['benchmarks']:
+        if benchmark['name'] in previous:
+            before = previous[benchmark['name']]['stats']['mean']
+            after = benchmark['stats']['mean']
+            print('%-40s %11.4fs %11.4fs %7.2fx' % (benchmark['name'], before, after, before / after if after else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=20, help='samples in the synthetic project')
+    parser.add_argument('--vcfs', type=int, default=2, help='VCF files per sample')
+    parser.add_argument('--records', type=int, default=2000, help='records per VCF')
+    parser.add_argument('--expectations', type=int, default=50, help='contrived expectations per sample')
+    parser.add_argument('--uams-vcfs', type=int, default=2, help='annotated VCFs imported into SQLite')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every stand-in response')
+    parser.add_argument('--workers', type=int, default=4, help='process pool size for the parallel metrics run')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic data directory')
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix='bpa-bench-')
+    project_id = 'bpa-BENCH'
+    params = {'samples': args.samples, 'vcfs': args.vcfs, 'records': args.records,
+              'expectations': args.expectations, 'latency': args.latency}
+
+    try:
+        print('Building synthetic project in %s' % work_path)
+        graph, vcf_files = synthetic_data.build_project(work_path, project_id, args.samples, args.vcfs,
+                                                        args.records, args.expectations)
+        rng = synthetic_data.random.Random(2)
+        uams_vcfs = []
+        uams_gz_vcfs = []
+        for i in range(args.uams_vcfs):
+            vcf_name = 'uams_%d.vcf' % i
+            records = synthetic_data.random_records(rng, args.records)
+            # both scenarios import the same records: the compressed copy is bgzipped from the plain file
+            plain_path = synthetic_data.write_vcf(os.path.join(work_path, vcf_name), records, rng,
+                                                  samples=('NORMAL', 'TUMOR'), annotate=True, compress=False)
+            synthetic_data.compress_vcf(plain_path)
+            uams_vcfs.append(vcf_name)
+            uams_gz_vcfs.append(vcf_name + '.gz')
+
+        server = graphql_server.serve(graph, latency=args.latency)
+        bp.client.url = 'http://127.0.0.1:%d/' % server.server_port
+        keys_path = os.path.join(work_path, 'credentials.json')
+        with open(keys_path, 'w') as f:
+            json.dump({'api_key': 'benchmark', 'key_id': 'benchmark'}, f)
+        bp.add_keys(keys_path)
+        bp.disable_cache()
+
+        path = work_path + os.sep
+        scenarios = [
+            ('query_project', lambda: bp.query_project(project_id)),
+            ('list_files', lambda: bp.list_files(project_id)),
+            ('count_file_types', lambda: bp.count_file_types(project_id)),
+            ('calculate_metrics_all_vcf', lambda: bp.calculate_metrics_all_vcf(project_id, path, vcf_files)),
+            ('calculate_metrics_all_vcf[workers=%d]' % args.workers,
+             lambda: bp.calculate_metrics_all_vcf(project_id, path, vcf_files, workers=args.workers)),
+            ('uams_sqlite_import', lambda: uams_import(work_path, uams_vcfs)),
+            ('uams_sqlite_import[vcf.gz]', lambda: uams_import(work_path, uams_gz_vcfs)),
+        ]
+
+        results = {
+            'machine_info': {'python_version': platform.python_version(), 'platform': platform.platform(),
+                             'processor': platform.processor()},
+            'datetime': datetime.datetime.utcnow().isoformat(),
+            'params': params,
+            'benchmarks': [run_scenario(name, function, args.rounds, server, params) for name, function in scenarios]
+        }
+        bp.client.session.close()
+        server.shutdown()
+        server.server_close()
+
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Results written to %s' % args.output)
+
+        if args.compare:
+            compare(results, args.compare)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
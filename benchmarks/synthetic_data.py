@@ -0,0 +1,115 @@
+''' Synthetic projects and VCF files for the benchmark suite '''
+
+import os
+import random
+
+import pysam
+
+from graphql_server import Graph
+
+chromosomes = [str(c) for c in range(1, 23)] + ['X']
+
+vcf_header = '''##fileformat=VCFv4.2
+##FILTER=<ID=PASS,Description="All filters passed">
+##FILTER=<ID=LowQual,Description="Low quality">
+##INFO=<ID=MAF,Number=A,Type=Float,Description="Mutant allele frequency">
+##INFO=<ID=ANN,Number=.,Type=String,Description="Functional annotations">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth">
+##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele frequency">
+%s#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO%s
+'''
+
+genes = ['TP53', 'KRAS', 'EGFR', 'PIK3CA', 'BRAF', 'APC', 'PTEN', 'NRAS']
+
+
+def random_records(rng, n_records):
+    ''' Sorted (chrom, pos) pairs spread over the autosomes and X '''
+
+    positions = set()
+    while len(positions) < n_records:
+        positions.add((rng.randint(0, len(chromosomes) - 1), rng.randint(1, 50000000)))
+
+    return [(chromosomes[c], pos) for c, pos in sorted(positions)]
+
+
+def write_vcf(path, records, rng, pass_fraction=0.9, samples=(), annotate=False, compress=True):
+    ''' Write a VCF with MAF fields (and optionally snpEff annotations and samples), bgzipped and tabix indexed '''
+
+    contigs = ''.join('##contig=<ID=chr%s,length=250000000>\n' % c for c in chromosomes)
+    columns = '\tFORMAT\t' + '\t'.join(samples) if samples else ''
+
+    plain_path = path[:-len('.gz')] if path.endswith('.gz') else path
+    with open(plain_path, 'w') as f:
+        f.write(vcf_header % (contigs, columns))
+        for chrom, pos in records:
+            ref, alt = rng.sample('ACGT', 2)
+            status = 'PASS' if rng.random() < pass_fraction else 'LowQual'
+            info = 'MAF=%.4f' % rng.uniform(0.001, 0.3)
+            if annotate:
+                gene = rng.choice(genes)
+                info += ';ANN=%s|missense_variant|MODERATE|%s|ENSG%011d|transcript|ENST%011d|protein_coding|1/10|' \
+                        'c.%d%s>%s|p.Gly%dAsp|||||' % (alt, gene, pos % 99991, pos % 99989, pos % 3000, ref, alt,
+                                                       pos % 1000)
+            line = 'chr%s\t%d\t.\t%s\t%s\t%.1f\t%s\t%s' % (chrom, pos, ref, alt, rng.uniform(10, 100), status, info)
+            if samples:
+                line += '\tGT:DP:AF'
+                for _ in samples:
+                    line += '\t0/1:%d:%.3f' % (rng.randint(20, 500), rng.uniform(0.01, 0.5))
+            f.write(line + '\n')
+
+    if not compress:
+        return plain_path
+
+    return pysam.tabix_index(plain_path, preset='vcf', force=True)
+
+
+def compress_vcf(plain_path):
+    ''' Write a bgzipped, tabix indexed copy of a plain VCF next to it, keeping the plain file '''
+
+    pysam.tabix_compress(plain_path, plain_path + '.gz', force=True)
+
+    return pysam.tabix_index(plain_path + '.gz', preset='vcf', force=True)
+
+
+def build_project(path, project_id='bpa-BENCH', n_samples=20, vcfs_per_sample=2, records_per_vcf=2000,
+                  expectations_per_sample=50, hit_fraction=0.8, seed=1):
+    ''' Build a synthetic project graph and write its VCF files (with matching expectations) under path '''
+
+    rng = random.Random(seed)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    graph = Graph()
+    graph.add('project', project_id=project_id, submitter_id=project_id)
+    case = graph.add('case', project_id=project_id, submitter_id='%s-case' % project_id)
+    graph.add('diagnosis', case, project_id=project_id, primary_diagnosis=rng.choice(['Lung', 'Breast', 'Colon']))
+    experiment = graph.add('experiment', project_id=project_id, submitter_id='%s-experiment' % project_id)
+    graph.add('experiment_metadata', experiment, project_id=project_id, file_name='%s-metadata.csv' % project_id)
+
+    vcf_files = {}
+    for i in range(n_samples):
+        sample_id = 'S%05d' % i
+        sample = graph.add('sample', case, project_id=project_id, submitter_id=sample_id)
+        aliquot = graph.add('aliquot', sample, project_id=project_id, submitter_id='%s-aliquot' % sample_id)
+        analyte = graph.add('analyte', aliquot, project_id=project_id, submitter_id='%s-analyte' % sample_id)
+        read_group = graph.add('read_group', analyte, project_id=project_id, submitter_id='%s-rg' % sample_id)
+        graph.add('submitted_aligned_reads', read_group, project_id=project_id, file_name='%s.bam' % sample_id)
+        graph.add('submitted_unaligned_reads', read_group, project_id=project_id, file_name='%s.fastq.gz' % sample_id)
+
+        records = random_records(rng, records_per_vcf)
+        expected = rng.sample(records, min(len(records), int(expectations_per_sample * hit_fraction)))
+        expected += random_records(rng, expectations_per_sample - len(expected))
+        for chrom, pos in expected:
+            graph.add('contrived_expectation', aliquot, project_id=project_id,
+                      expected_mutation_chromosome='chr' + chrom, expected_mutation_position=str(pos),
+                      expected_mutation_gene=rng.choice(genes))
+
+        vcf_files[sample_id] = []
+        for v in range(vcfs_per_sample):
+            vcf_name = '%s_%d.vcf.gz' % (sample_id, v)
+            graph.add('submitted_somatic_mutation', read_group, project_id=project_id, file_name=vcf_name)
+            write_vcf(os.path.join(path, vcf_name), records, rng)
+            vcf_files[sample_id].append(vcf_name)
+
+    return graph, vcf_files
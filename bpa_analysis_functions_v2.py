@@ -3,8 +3,21 @@ import subprocess
 import glob
 import os
 import sys
+import time
+import base64
+import hashlib
+import sqlite3
+import threading
+import collections
+import array
+import fnmatch
+import re
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import shutil
 import pysam
 import numpy as np
 import matplotlib.pyplot as plt
@@ -12,7 +25,14 @@ from operator import add
 
 pysam.set_verbosity(0)
 
-auth = ''
+api_url = 'https://data.bloodpac.org/'
+token_endpoint = 'user/credentials/cdis/access_token'
+graphql_endpoint = 'api/v0/submission/graphql/'
+cache_location = os.path.expanduser('~/.bpa_query_cache.sqlite')
+bucket = 'bpa-data'
+aws_command = 'aws'
+transfer_manifest = '.bpa_transfers.json'
+data_cache_location = os.path.expanduser('~/.bpa_data_cache')
 
 main_header_order = [
     'Sample',
@@ -24,6 +44,18 @@ main_header_order = [
     'Specificity'
 ]
 
+curve_header_order = [
+    'Sample',
+    'VCF File',
+    'MAF Cutoff',
+    'QUAL Cutoff',
+    'Expectations',
+    'True-Positive',
+    'False-Positive',
+    'Sensitivity',
+    'Specificity'
+]
+
 data_types = {
     'VCF': 'submitted_somatic_mutations',
     'FASTQ': 'submitted_unaligned_reads_files',
@@ -35,6 +67,35 @@ metadata_types = {
     'METADATA': 'experiment_metadata_files'
 }
 
+instrumentation_header_order = [
+    'Kind',
+    'Name',
+    'Calls',
+    'Total (s)',
+    'Mean (s)',
+    'Max (s)',
+    'Network (s)',
+    'Parse (s)',
+    'Request Bytes',
+    'Response Bytes',
+    'Records',
+    'Records/s',
+    'Expectations',
+    'Transferred Bytes',
+    'Errors'
+]
+
+chromosome_codes = {
+    'X': 23,
+    'Y': 24,
+    'M': 25,
+    'MT': 26
+}
+
+# Codes of the other contigs, handed out in order of first use
+contig_codes = {}
+contig_codes_lock = threading.Lock()
+
 
 class arrayTable(list):
     ''' Represent result arrays in HTML format for visualization '''
@@ -92,16 +153,18 @@ class SummaryTable(dict):
 class MetricsTable(list):
     ''' Represent result tables in HTML format for visualization '''
     
+    header_order = main_header_order
+
     def _repr_html_(self):
         html = []
         html.append("<table style>")
         html.append("<thead>")
-        for key in main_header_order:  
+        for key in self.header_order:  
             html.append("<th>%s</th>" % key)
         html.append("</thead>")       
         for line in self:
             html.append("<tr>") 
-            for key in main_header_order:
+            for key in self.header_order:
                 html.append("<td>%s</td>" % line[key])
             html.append("<tr>") 
         html.append("</table>")        
@@ -109,17 +172,616 @@ class MetricsTable(list):
         return ''.join(html)
 
 
-def add_keys(filename):
+class CurveTable(MetricsTable):
+    ''' Represent metrics at several MAF/QUAL cutoffs in HTML format for visualization '''
+
+    header_order = curve_header_order
+
+
+class InstrumentationReport(MetricsTable):
+    ''' Represent per-session timing totals as a table, in HTML or plain text '''
+
+    header_order = instrumentation_header_order
+
+    def __str__(self):
+        columns = [key for key in self.header_order if any(line.get(key) != '' for line in self)]
+        lines = [[str(key) for key in columns]]
+        for line in self:
+            lines.append([str(line[key]) for key in columns])
+        widths = [max(len(line[i]) for line in lines) for i in range(len(columns))]
+
+        return '\n'.join('  '.join(value.ljust(width) for value, width in zip(line, widths)) for line in lines)
+
+
+class Instrumentation(object):
+    ''' Collect timing and payload events from the API, VCF and transfer hot paths and pass them to hooks '''
+
+    # Event measures summed in the report, by report column
+    totals = {
+        'request_bytes': 'Request Bytes',
+        'response_bytes': 'Response Bytes',
+        'records': 'Records',
+        'expectations': 'Expectations',
+        'transferred_bytes': 'Transferred Bytes',
+        'error': 'Errors'
+    }
+    durations = {
+        'network': 'Network (s)',
+        'parse': 'Parse (s)'
+    }
+
+    def __init__(self, hooks=None, keep_events=True):
+        self.hooks = list(hooks or [])
+        self.keep_events = keep_events
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        ''' Call hook(event) with the event dictionary after every measured call '''
+
+        self.hooks.append(hook)
+
+    def record(self, kind, name, start, **measures):
+        ''' Record one event of a kind (api, vcf, transfer) that started at start '''
+
+        event = dict(measures, kind=kind, name=name, elapsed=time.time() - start)
+        self.add(event)
+
+        return event
+
+    def add(self, event):
+        with self.lock:
+            if self.keep_events:
+                self.events.append(event)
+        for hook in self.hooks:
+            hook(event)
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+
+    def report(self):
+        ''' Aggregate the recorded events by kind and name '''
+
+        rows = collections.OrderedDict()
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            row = rows.get((event['kind'], event['name']))
+            if row is None:
+                row = dict((key, '') for key in instrumentation_header_order)
+                row.update({'Kind': event['kind'], 'Name': event['name'], 'Calls': 0, 'Total (s)': 0.0, 'Max (s)': 0.0})
+                rows[(event['kind'], event['name'])] = row
+            row['Calls'] += 1
+            row['Total (s)'] += event['elapsed']
+            row['Max (s)'] = max(row['Max (s)'], event['elapsed'])
+            for measure, column in self.totals.items():
+                if measure in event:
+                    row[column] = (row[column] or 0) + int(bool(event[measure]) if measure == 'error' else event[measure])
+            for measure, column in self.durations.items():
+                if measure in event:
+                    row[column] = (row[column] or 0.0) + event[measure]
+
+        report = InstrumentationReport()
+        for row in rows.values():
+            if row['Records'] != '' and row['Total (s)'] > 0:
+                row['Records/s'] = int(row['Records'] / row['Total (s)'])
+            row['Mean (s)'] = round(row['Total (s)'] / row['Calls'], 4)
+            row['Total (s)'] = round(row['Total (s)'], 4)
+            row['Max (s)'] = round(row['Max (s)'], 4)
+            for column in self.durations.values():
+                if row[column] != '':
+                    row[column] = round(row[column], 4)
+            report.append(row)
+
+        return report
+
+
+instrumentation = None
+
+
+def enable_instrumentation(hooks=None, keep_events=True):
+    ''' Start measuring API queries, VCF scoring and bucket transfers for this session '''
+
+    global instrumentation
+
+    instrumentation = Instrumentation(hooks, keep_events)
+
+    return instrumentation
+
+
+def disable_instrumentation():
+    ''' Stop measuring '''
+
+    global instrumentation
+
+    instrumentation = None
+
+
+def add_instrumentation_hook(hook):
+    ''' Call hook(event) after every measured call, enabling instrumentation if needed '''
+
+    if instrumentation is None:
+        enable_instrumentation()
+    instrumentation.add_hook(hook)
+
+
+def instrumentation_report():
+    ''' Table of the calls measured so far in this session '''
+
+    if instrumentation is None:
+        return InstrumentationReport()
+
+    return instrumentation.report()
+
+
+def query_name(query_txt):
+    ''' Operation name of a GraphQL query, or its first top-level field '''
+
+    match = re.match(r'\s*query\s+(\w+)', query_txt) or re.match(r'[^{]*\{\s*(?:\w+\s*:\s*)?(\w+)', query_txt)
+
+    return match.group(1) if match else 'query'
+
+
+class APIClient(object):
+    ''' Keep-alive HTTP session and cached access token for the data commons API '''
+
+    def __init__(self, url=api_url, pool_size=10, refresh_margin=300, token_lifetime=1200):
+        self.url = url
+        self.refresh_margin = refresh_margin
+        self.token_lifetime = token_lifetime
+        self.keys = None
+        self.token_file = None
+        self.access_token = None
+        self.expires = 0
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.set_pool_size(pool_size)
+
+    def set_pool_size(self, pool_size):
+        ''' Mount HTTP adapters keeping up to pool_size connections alive '''
+
+        self.pool_size = pool_size
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def set_keys(self, keys, token_file=None):
+        ''' Store API keys and load a previously persisted token, if any '''
+
+        with self.lock:
+            self.keys = keys
+            self.token_file = token_file
+            self.access_token = None
+            self.expires = 0
+            if token_file and os.path.exists(token_file):
+                try:
+                    cached = json.loads(open(token_file).read())
+                    self.access_token = cached['access_token']
+                    self.expires = cached['expires']
+                except (ValueError, KeyError):
+                    pass
+
+    def token_expiration(self, access_token):
+        ''' Read the expiration time from the JWT payload, or assume the default lifetime '''
+
+        try:
+            payload = access_token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return json.loads(base64.urlsafe_b64decode(str(payload)))['exp']
+        except (IndexError, ValueError, KeyError, TypeError):
+            return time.time() + self.token_lifetime
+
+    def refresh_token(self):
+        ''' Request a new access token and persist it with its expiration time '''
+
+        if self.keys is None:
+            raise ValueError('No API keys loaded, call add_keys first')
+
+        response = self.session.post(self.url + token_endpoint, json=self.keys)
+        response.raise_for_status()
+        self.access_token = response.json()['access_token']
+        self.expires = self.token_expiration(self.access_token)
+
+        if self.token_file:
+            fd = os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps({'access_token': self.access_token, 'expires': self.expires}))
+
+    def get_token(self, force=False):
+        ''' Return the cached access token, refreshing it only when it is about to lapse '''
+
+        with self.lock:
+            if force or not self.access_token or time.time() > self.expires - self.refresh_margin:
+                self.refresh_token()
+            return self.access_token
+
+    def post(self, query):
+        ''' Send a GraphQL query over the pooled session '''
+
+        url = self.url + graphql_endpoint
+        response = self.session.post(url, headers={'Authorization': 'bearer ' + self.get_token()}, json=query)
+        if response.status_code == 401:
+            response = self.session.post(url, headers={'Authorization': 'bearer ' + self.get_token(force=True)}, json=query)
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+
+        return response.text
+
+
+client = APIClient()
+
+
+def add_keys(filename, pool_size=None):
     ''' Get auth from our secret keys '''
 
-    global auth 
-    
     json_data=open(filename).read()
     keys = json.loads(json_data)
-    auth = requests.post('https://data.bloodpac.org/user/credentials/cdis/access_token', json=keys)   
-    
+    if pool_size:
+        client.set_pool_size(pool_size)
+    client.set_keys(keys, token_file=filename + '.token')
+    client.get_token()
+
+
+class TransferManager(object):
+    ''' Copy bucket objects with several concurrent, resumable aws cli transfers '''
+
+    def __init__(self, profile, concurrency=4, chunk_size=64 * 1024 * 1024):
+        self.profile = profile
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        # re-entrant, so progress can be reported while the counters are held
+        self.lock = threading.RLock()
+        self.manifest = {}
+        self.manifest_path = None
+        self.done = 0
+        self.total = 0
+
+    def aws(self, args):
+        ''' Run one aws cli command, streaming its error output '''
+
+        cmd = [aws_command] + args + ['--profile', self.profile]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, error)
+
+        return output
+
+    def list_objects(self, prefix):
+        ''' List keys, sizes and ETags under a bucket prefix '''
+
+        output = self.aws(['s3api', 'list-objects-v2', '--bucket', bucket, '--prefix', prefix, '--output', 'json'])
+        if not output.strip():
+            return []
+
+        return json.loads(output).get('Contents', [])
+
+    def load_manifest(self, files_path):
+        ''' Read the size/ETag of every object already transferred to files_path '''
+
+        self.manifest_path = os.path.join(files_path, transfer_manifest)
+        if os.path.exists(self.manifest_path):
+            try:
+                self.manifest = json.loads(open(self.manifest_path).read())
+            except ValueError:
+                self.manifest = {}
+
+    def save_manifest(self):
+        ''' Persist the transferred object list next to the files '''
+
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            f.write(json.dumps(self.manifest, indent=1, sort_keys=True))
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
+
+    def is_current(self, obj, local_path):
+        ''' Check whether a local file already matches the object size and ETag '''
+
+        if not os.path.isfile(local_path) or os.path.getsize(local_path) != obj['Size']:
+            return False
+
+        etag = obj['ETag'].strip('"')
+        checksum = data_cache.source_checksum(obj['Key'], etag) if data_cache is not None else None
+        if checksum is not None:
+            # A cached copy may have been edited in place through another link, the manifest cannot tell
+            return not data_cache.verify or data_cache.checksum(local_path) == checksum
+        if obj['Key'] in self.manifest:
+            return self.manifest[obj['Key']]['etag'] == etag
+        if '-' in etag:
+            # Multipart ETags are not a plain checksum, trust the size
+            return True
+
+        md5 = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(block)
+
+        return md5.hexdigest() == etag
+
+    def report(self, message):
+        with self.lock:
+            print message
+            sys.stdout.flush()
+
+    def discard_partials(self, local_path, keep=None):
+        ''' Remove the partial downloads of other versions of an object '''
+
+        local_dir = os.path.dirname(local_path) or '.'
+        # <name>.<etag>.part, or <name>.part left by a version that did not record the ETag
+        pattern = re.compile(re.escape(os.path.basename(local_path)) + r'(\.[0-9a-fA-F]+(-\d+)?)?\.part$')
+        for name in os.listdir(local_dir):
+            partial = os.path.join(local_dir, name)
+            if pattern.match(name) and partial != keep:
+                os.remove(partial)
+
+    def transfer(self, obj, local_path):
+        ''' Download one object in ranged chunks appended to a .part file, resuming where it stopped '''
+
+        etag = obj['ETag'].strip('"')
+        start = time.time()
+        try:
+            local_dir = os.path.dirname(local_path)
+            with self.lock:
+                if local_dir and not os.path.exists(local_dir):
+                    os.makedirs(local_dir)
+
+            if self.is_current(obj, local_path):
+                status = 'Local copy up to date'
+                outcome, transferred = 'up to date', 0
+            elif data_cache is not None and data_cache.fetch(obj['Key'], local_path, etag):
+                status = 'Linked from local cache'
+                outcome, transferred = 'cached', 0
+            else:
+                # the partial file is named after the object version its bytes came from, so a resume
+                # never appends ranges of a changed object to bytes of the old one
+                partial = '%s.%s.part' % (local_path, etag)
+                self.discard_partials(local_path, keep=partial)
+                offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+                if offset > obj['Size']:
+                    os.remove(partial)
+                    offset = 0
+                transferred = obj['Size'] - offset
+
+                while offset < obj['Size']:
+                    end = min(offset + self.chunk_size, obj['Size']) - 1
+                    chunk = partial + '.chunk'
+                    self.aws(['s3api', 'get-object', '--bucket', bucket, '--key', obj['Key'],
+                              '--range', 'bytes=%d-%d' % (offset, end), '--if-match', obj['ETag'], chunk])
+                    with open(partial, 'ab') as f_out, open(chunk, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+                    os.remove(chunk)
+                    offset = end + 1
+                    if obj['Size'] > self.chunk_size:
+                        self.report('  %s: %d%%' % (obj['Key'], 100 * offset / obj['Size']))
+
+                if not os.path.exists(partial):
+                    open(partial, 'wb').close()
+                if data_cache is not None:
+                    data_cache.link(data_cache.add(obj['Key'], partial, etag), local_path)
+                else:
+                    os.rename(partial, local_path)
+                status = 'Downloaded %d bytes' % transferred
+                if transferred < obj['Size']:
+                    status += ' (resumed at byte %d)' % (obj['Size'] - transferred)
+                outcome = 'downloaded'
+
+            with self.lock:
+                self.manifest[obj['Key']] = {'size': obj['Size'], 'etag': etag}
+                self.save_manifest()
+                self.done += 1
+                self.report('[%d/%d] %s: %s' % (self.done, self.total, obj['Key'], status))
+            if instrumentation is not None:
+                instrumentation.record('transfer', outcome, start, key=obj['Key'], size=obj['Size'],
+                                       transferred_bytes=transferred)
+
+            return local_path, None
+        except (subprocess.CalledProcessError, IOError, OSError) as e:
+            error = getattr(e, 'output', None) or str(e)
+            with self.lock:
+                self.done += 1
+                self.report('[%d/%d] ERROR: %s: %s' % (self.done, self.total, obj['Key'], error))
+            if instrumentation is not None:
+                instrumentation.record('transfer', 'failed', start, key=obj['Key'], size=obj['Size'],
+                                       transferred_bytes=0, error=error)
+
+            return local_path, error
+
+    def get_files(self, prefix, files_path, patterns=None):
+        ''' Transfer every object under prefix (or only those matching patterns) into files_path '''
+
+        self.load_manifest(files_path)
+
+        objects = []
+        for obj in self.list_objects(prefix):
+            name = obj['Key'][len(prefix):]
+            if not name or name.endswith('/'):
+                continue
+            if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                continue
+            objects.append((obj, os.path.join(files_path, name)))
+
+        self.done = 0
+        self.total = len(objects)
+        if not objects:
+            return []
+
+        pool = ThreadPool(min(self.concurrency, len(objects)))
+        try:
+            results = pool.map(lambda args: self.transfer(*args), objects)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [local_path for local_path, error in results if error is None]
+
+
+class DataCache(object):
+    ''' Content-addressed store of downloaded files shared by every working directory '''
+
+    def __init__(self, root=data_cache_location, quota=100 * 1024 ** 3, verify=True):
+        self.root = root
+        self.quota = quota
+        self.verify = verify
+        self.lock = threading.Lock()
+        if not os.path.exists(os.path.join(root, 'objects')):
+            os.makedirs(os.path.join(root, 'objects'))
+        self.conn = sqlite3.connect(os.path.join(root, 'manifest.sqlite'), check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS objects (
+                checksum TEXT PRIMARY KEY,
+                size INTEGER,
+                accessed REAL
+            );
+            CREATE TABLE IF NOT EXISTS sources (
+                source_key TEXT PRIMARY KEY,
+                checksum TEXT,
+                etag TEXT
+            );
+            CREATE INDEX IF NOT EXISTS objects_accessed ON objects (accessed);
+        ''')
+        self.conn.commit()
+
+    def object_path(self, checksum):
+        return os.path.join(self.root, 'objects', checksum[:2], checksum)
+
+    def checksum(self, file_path):
+        ''' SHA-256 of a file read in blocks '''
+
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+
+        return sha.hexdigest()
+
+    def lookup(self, source_key, etag=None):
+        ''' Return the verified cached copy of a source key, or None on a miss '''
+
+        with self.lock:
+            row = self.conn.execute('SELECT s.checksum, s.etag, o.size FROM sources s '
+                                    'JOIN objects o ON o.checksum = s.checksum '
+                                    'WHERE s.source_key = ?', (source_key,)).fetchone()
+        if row is None:
+            return None
+
+        checksum, cached_etag, size = row
+        path = self.object_path(checksum)
+        stale = etag is not None and cached_etag is not None and etag != cached_etag
+        corrupt = not os.path.isfile(path) or os.path.getsize(path) != size or \
+                  (self.verify and self.checksum(path) != checksum)
+
+        with self.lock:
+            if stale or corrupt:
+                self.conn.execute('DELETE FROM sources WHERE source_key = ?', (source_key,))
+                if corrupt:
+                    self.conn.execute('DELETE FROM sources WHERE checksum = ?', (checksum,))
+                    self.conn.execute('DELETE FROM objects WHERE checksum = ?', (checksum,))
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.conn.commit()
+                return None
+
+            self.conn.execute('UPDATE objects SET accessed = ? WHERE checksum = ?', (time.time(), checksum))
+            self.conn.commit()
+
+        return path
+
+    def source_checksum(self, source_key, etag=None):
+        ''' Recorded checksum of the cached copy of a source key, without reading the object '''
+
+        with self.lock:
+            row = self.conn.execute('SELECT checksum, etag FROM sources WHERE source_key = ?',
+                                    (source_key,)).fetchone()
+        if row is None or (etag is not None and row[1] is not None and etag != row[1]):
+            return None
+
+        return row[0]
+
+    def add(self, source_key, file_path, etag=None):
+        ''' Move a downloaded file into the store and record its size, checksum and source key '''
+
+        checksum = self.checksum(file_path)
+        path = self.object_path(checksum)
+        with self.lock:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if os.path.exists(path):
+                os.remove(file_path)
+            else:
+                shutil.move(file_path, path)
+            # Working directories share the object through hard links, so none of them may write to it
+            os.chmod(path, 0o444)
+            self.conn.execute('INSERT OR REPLACE INTO objects (checksum, size, accessed) VALUES (?, ?, ?)',
+                              (checksum, os.path.getsize(path), time.time()))
+            self.conn.execute('INSERT OR REPLACE INTO sources (source_key, checksum, etag) VALUES (?, ?, ?)',
+                              (source_key, checksum, etag))
+            self.conn.commit()
+            self.evict(keep=checksum)
+
+        return path
+
+    def link(self, path, dest):
+        ''' Expose a cached file in a working directory with a hard link, or a symlink across devices '''
+
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            os.symlink(path, dest)
+
+        return dest
+
+    def fetch(self, source_key, dest, etag=None):
+        ''' Link the cached copy of a source key to dest, returning False on a miss '''
+
+        path = self.lookup(source_key, etag)
+        if path is None:
+            return False
+
+        self.link(path, dest)
+
+        return True
+
+    def evict(self, keep=None):
+        ''' Remove the least recently used objects until the store fits in its quota '''
+
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+        for checksum, size in self.conn.execute('SELECT checksum, size FROM objects ORDER BY accessed').fetchall():
+            if total <= self.quota:
+                break
+            if checksum == keep:
+                continue
+            if os.path.exists(self.object_path(checksum)):
+                os.remove(self.object_path(checksum))
+            self.conn.execute('DELETE FROM sources WHERE checksum = ?', (checksum,))
+            self.conn.execute('DELETE FROM objects WHERE checksum = ?', (checksum,))
+            total -= size
+        self.conn.commit()
+
+
+data_cache = None
+
+
+def enable_data_cache(root=data_cache_location, quota=100 * 1024 ** 3, verify=True):
+    ''' Share downloaded files between working directories through a content-addressed cache '''
+
+    global data_cache
 
-def get_files_from_bucket(project, profile, files_path, files=None):
+    data_cache = DataCache(root, quota, verify)
+
+    return data_cache
+
+
+def disable_data_cache():
+    ''' Download files straight into each working directory again '''
+
+    global data_cache
+
+    data_cache = None
+
+
+def get_files_from_bucket(project, profile, files_path, files=None, concurrency=4):
     ''' Transfer data from object storage to the VM in the private subnet '''
 
     # Create folder
@@ -128,7 +790,6 @@ def get_files_from_bucket(project, profile, files_path, files=None):
 
     # Get bucket name and path
     bucket_name = project.replace('bpa-', 'BPA_')
-    s3_path = 's3://bpa-data/' + bucket_name
     
     # If only one file or a pattern, create array
     if isinstance(files, str):
@@ -136,26 +797,140 @@ def get_files_from_bucket(project, profile, files_path, files=None):
     
     # Getting files
     print "Getting files..."
-    if files:
-       for f in files:
-          s3_path = s3_path + '/'
-          cmd = ['aws', 's3', 'cp', s3_path, files_path, '--recursive', '--profile', profile, '--exclude', '*', '--include', f]
-          try:
-              output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)       
-          except Exception as e:
-              output = e.output
-              print "ERROR:" + output          
-    else: 
-       cmd = ['aws', 's3', 'sync', s3_path, files_path, '--profile', profile]
-       try:
-          output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)       
-       except Exception as e:
-          output = e.output
-          print "ERROR:" + output
+    manager = TransferManager(profile, concurrency)
+    try:
+       local_files = manager.get_files(bucket_name + '/', files_path, files)
+    except subprocess.CalledProcessError as e:
+       local_files = []
+       print "ERROR:" + str(e.output)
     print "Finished"
 
+    return local_files
+
     
-def query_api(query_txt, variables = None):
+class QueryCache(object):
+    ''' Cache GraphQL responses in an in-memory LRU tier backed by an optional SQLite tier '''
+
+    def __init__(self, path=None, ttl=86400, max_memory_entries=256, max_disk_entries=10000):
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                              'key TEXT PRIMARY KEY, response TEXT, expires REAL, accessed REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self.conn.commit()
+
+    def key(self, query_txt, variables=None):
+        ''' Hash the whitespace-normalized query text, its variables and the API location '''
+
+        normalized = ' '.join(query_txt.split())
+        content = json.dumps([client.url, normalized, variables], sort_keys=True)
+
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        ''' Return the cached response text for a key, or None if missing or expired '''
+
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                expires, response = self.memory.pop(key)
+                if expires > now:
+                    self.memory[key] = (expires, response)
+                    return response
+
+            if self.conn is None:
+                return None
+
+            row = self.conn.execute('SELECT response, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.conn.commit()
+                return None
+
+            self.conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+            self.remember(key, row[1], row[0])
+
+            return row[0]
+
+    def set(self, key, response, ttl=None):
+        ''' Store a response text in both tiers and evict the least recently used entries '''
+
+        now = time.time()
+        expires = now + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            self.remember(key, expires, response)
+            if self.conn is not None:
+                self.conn.execute('INSERT OR REPLACE INTO responses (key, response, expires, accessed) '
+                                  'VALUES (?, ?, ?, ?)', (key, response, expires, now))
+                self.conn.execute('DELETE FROM responses WHERE expires <= ?', (now,))
+                self.conn.execute('DELETE FROM responses WHERE key IN '
+                                  '(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                                  (self.max_disk_entries,))
+                self.conn.commit()
+
+    def remember(self, key, expires, response):
+        ''' Insert an entry in the memory tier keeping it within its size bound '''
+
+        self.memory.pop(key, None)
+        self.memory[key] = (expires, response)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def invalidate(self, query_txt=None, variables=None):
+        ''' Drop one query from the cache, or every entry if no query is given '''
+
+        with self.lock:
+            if query_txt is None:
+                self.memory.clear()
+                if self.conn is not None:
+                    self.conn.execute('DELETE FROM responses')
+                    self.conn.commit()
+            else:
+                key = self.key(query_txt, variables)
+                self.memory.pop(key, None)
+                if self.conn is not None:
+                    self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self.conn.commit()
+
+
+cache = None
+
+
+def enable_cache(path=cache_location, ttl=86400, max_memory_entries=256, max_disk_entries=10000):
+    ''' Cache query_api responses in memory and, if a path is given, on disk '''
+
+    global cache
+
+    cache = QueryCache(path, ttl, max_memory_entries, max_disk_entries)
+
+    return cache
+
+
+def disable_cache():
+    ''' Send every query to the API again '''
+
+    global cache
+
+    cache = None
+
+
+def invalidate_cache(query_txt=None, variables=None):
+    ''' Remove one query, or all of them, from the response cache '''
+
+    if cache is not None:
+        cache.invalidate(query_txt, variables)
+
+
+def query_api(query_txt, variables = None, use_cache=True):
     ''' Request results for a specific query '''
 
     if variables == None:
@@ -163,100 +938,289 @@ def query_api(query_txt, variables = None):
     else:
         query = {'query': query_txt, 'variables': variables}        
     
-    output = requests.post('https://data.bloodpac.org/api/v0/submission/graphql/' , 
-                           headers={'Authorization': 'bearer '+ auth.json()['access_token']}, 
-                           json=query).text
-    data = json.loads(output)    
+    start = time.time()
+    output = None
+    cached = False
+    if cache is not None and use_cache:
+        key = cache.key(query_txt, variables)
+        output = cache.get(key)
+        cached = output is not None
+
+    if output is None:
+        output = client.post(query)
+    network = time.time() - start
+
+    data = json.loads(output)
+    if cache is not None and use_cache and not cached and 'errors' not in data:
+        cache.set(key, output)
     
     if 'errors' in data:
         print data    
+
+    if instrumentation is not None:
+        instrumentation.record('api', query_name(query_txt), start, network=network, cached=cached,
+                               request_bytes=len(json.dumps(query)), response_bytes=len(output),
+                               error='errors' in data)
     
     return data  
 
 
-def query_project_samples(project_id):
+class TokenBucket(object):
+    ''' Limit the rate of requests shared by several threads '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        ''' Block until one request can be sent '''
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QueryExecutor(object):
+    ''' Fan independent API calls out over a bounded thread pool with rate limiting and retries '''
+
+    def __init__(self, concurrency=8, rate=None, burst=None, retries=3, backoff=1.0):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+
+    def call(self, function, args):
+        ''' Run one call, retrying with exponential backoff on network and server errors '''
+
+        attempt = 0
+        while True:
+            if self.bucket:
+                self.bucket.acquire()
+            try:
+                return function(*args)
+            except requests.RequestException:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+    def map(self, function, args_list):
+        ''' Call function once per argument tuple and return the results in input order '''
+
+        args_list = list(args_list)
+        if self.concurrency <= 1 or len(args_list) <= 1:
+            return [self.call(function, args) for args in args_list]
+
+        pool = ThreadPool(min(self.concurrency, len(args_list)))
+        try:
+            return pool.map(lambda args: self.call(function, args), args_list)
+        finally:
+            pool.close()
+            pool.join()
+
+
+executor = QueryExecutor()
+
+
+def set_concurrency(concurrency=8, rate=None, burst=None, retries=3, backoff=1.0):
+    ''' Configure how many API requests run in parallel and how fast they are sent '''
+
+    global executor
+
+    executor = QueryExecutor(concurrency, rate, burst, retries, backoff)
+    if client.pool_size < concurrency:
+        client.set_pool_size(concurrency)
+
+    return executor
+
+
+def graphql_args(args):
+    ''' Render a dictionary as GraphQL query arguments '''
+
+    items = []
+    for key in sorted(args):
+        value = args[key]
+        if isinstance(value, dict):
+            items.append('%s: {%s}' % (key, graphql_args(value)))
+        elif isinstance(value, (list, tuple)):
+            items.append('%s: [%s]' % (key, ', '.join(json.dumps(v) for v in value)))
+        elif isinstance(value, bool):
+            items.append('%s: %s' % (key, str(value).lower()))
+        elif isinstance(value, basestring):
+            items.append('%s: %s' % (key, json.dumps(value)))
+        else:
+            items.append('%s: %s' % (key, value))
+
+    return ', '.join(items)
+
+
+def iter_nodes(node, fields, page_size=1000, use_cache=True, **filters):
+    ''' Walk the records of one node in offset/first pages and yield them lazily '''
+
+    if not isinstance(fields, basestring):
+        fields = ' '.join(fields)
+
+    offset = 0
+    while True:
+        args = dict(filters, first=page_size, offset=offset)
+        query_txt = """{ %s(%s) { %s }} """ % (node, graphql_args(args), fields)
+
+        data = query_api(query_txt, use_cache=use_cache)
+        if 'errors' in data:
+            # A failed page must not pass for the end of the listing
+            raise RuntimeError('Query for %s (offset %d) failed: %s' % (node, offset, data['errors']))
+
+        records = (data.get('data') or {}).get(node) or []
+        if not records:
+            return
+        for record in records:
+            yield record
+
+        if len(records) < page_size:
+            return
+        offset += page_size
+
+
+def query_project_samples(project_id, page_size=1000):
     ''' Query samples for a specific project'''
 
-    query_txt = """query Test { sample (first:0, project_id: "%s") {
-                               submitter_id}} """ % (project_id)
+    samples = list(iter_nodes('sample', 'submitter_id', page_size, project_id=project_id))
 
-    data = query_api(query_txt)   
+    return {'data': {'sample': samples}}
 
-    return data
 
+def build_sample_fields(file_types=None, fields=('file_name',), counts=False):
+    ''' Compose the sample -> aliquot -> analyte -> read_group selection for only the requested file types and fields '''
+
+    if file_types is None:
+        file_types = data_types.keys()
+
+    leaves = []
+    for file_type in file_types:
+        node = data_types[file_type.upper()]
+        if counts:
+            leaves.append('_%s_count' % node)
+        leaves.append('%s { %s }' % (node, ' '.join(fields)))
 
-def query_sample(project_id, sample_id):
+    if counts:
+        return """submitter_id _aliquots_count aliquots { analytes { _read_groups_count read_groups { %s }}}""" % (' '.join(leaves))
+
+    return """submitter_id aliquots { analytes { read_groups { %s }}}""" % (' '.join(leaves))
+
+
+sample_files_fields = build_sample_fields(['VCF', 'FASTQ', 'BAM', 'CNV'], counts=True)
+
+
+def query_sample(project_id, sample_id, file_types=None):
     ''' Query alignment files from one sample'''
 
+    if file_types is None:
+        sample_fields = sample_files_fields
+    else:
+        sample_fields = build_sample_fields(file_types)
+
     query_txt = """{ sample (project_id: "%s", submitter_id: "%s") {
-                               submitter_id 
-                               _aliquots_count 
-                               aliquots {
-                               analytes {     
-                                  _read_groups_count 
-                                  read_groups {
-                                     _submitted_somatic_mutations_count submitted_somatic_mutations { file_name} 
-                                     _submitted_unaligned_reads_files_count submitted_unaligned_reads_files { file_name} 
-                                     _submitted_aligned_reads_files_count submitted_aligned_reads_files { file_name}
-                                     _submitted_copy_number_files_count submitted_copy_number_files { file_name}
-                                  } 
-                               }
-                               }
+                         %s
                          }
-                    } """ % (project_id, sample_id)
+                    } """ % (project_id, sample_id, sample_fields)
 
     data = query_api(query_txt)   
 
     return data
 
+
+def query_samples(project_id, sample_ids, file_types=None):
+    ''' Query alignment files from several samples in one request using aliased sub-queries'''
+
+    if file_types is None:
+        sample_fields = sample_files_fields
+    else:
+        sample_fields = build_sample_fields(file_types)
+
+    query_txt = "{ "
+    for i, sample_id in enumerate(sample_ids):
+        query_txt += """s%d: sample (project_id: "%s", submitter_id: "%s") {
+                         %s
+                         } """ % (i, project_id, sample_id, sample_fields)
+    query_txt += "}"
+
+    data = query_api(query_txt)
+
+    samples = []
+    if data.get('data'):
+        for i in range(len(sample_ids)):
+            samples += data['data'].get('s%d' % i) or []
+
+    return {'data': {'sample': samples}}
+
+
+def count_nodes(node, **filters):
+    ''' Count the records of one node with its _<node>_count aggregate field '''
+
+    if filters:
+        query_txt = """{ _%s_count(%s) }""" % (node, graphql_args(filters))
+    else:
+        query_txt = """{ _%s_count }""" % (node)
+
+    data = query_api(query_txt)
+    if not data.get('data'):
+        return 0
+
+    return data['data']['_%s_count' % node] or 0
+
+
 def query_field_counts(node, fields):
     ''' Query summary counts for each data type '''
     
-    query_txt = """{ case(first:0, with_path_to: {type: "%s" """ % (node) 
+    path = {'type': node}
     for f in fields:
-        query_txt += """,%s: "%s" """ % (f, fields[f])
-    query_txt += """}){ project_id }}"""
-    
-    data = query_api(query_txt)    
-    
+        path[f] = '%s' % fields[f]
+
+    # One aggregate count per project, issued concurrently
+    projects = [p['project_id'] for p in iter_nodes('project', 'project_id')]
+    counts = executor.map(lambda project: count_nodes('case', project_id=project, with_path_to=path),
+                          [(project,) for project in projects])
+
     summary = {}
-    if 'data' in data and 'case' in data['data']:
-        for d in data['data']['case']:
-            project = d["project_id"]
-            if project not in summary:
-                summary[project] = {} 
-
-            summary[project].setdefault('COUNT', 0)                 
-            summary[project]['COUNT'] += 1 
+    for project, count in zip(projects, counts):
+        if count:
+            summary[project] = {'COUNT': count}
     
     return SummaryTable(summary)
 
 
-def query_summary_field(node, field, project_id=None):
+def query_summary_field(node, field, project_id=None, page_size=1000):
     ''' Query summary counts for each data type '''
     
-    if project_id != None:
-        query_txt = """query { %s(first:0, project_id: "%s") {%s}} """ % (node, project_id, field) 
+    if offline(project_id) and offline(project_id).iter_summary_records(node, field) is not None:
+        records = offline(project_id).iter_summary_records(node, field)
+    elif project_id != None:
+        records = iter_nodes(node, field, page_size, project_id=project_id)
     else:
-        query_txt = """query { %s(first:0) {%s project_id}} """ % (node, field)    
-    
-    data = query_api(query_txt)
+        records = iter_nodes(node, field + ' project_id', page_size)
     
-    summary = {}
-    total = []
-    for d in data['data'][node]:
+    # Records are streamed page by page into counters, never held all at once
+    summary = collections.Counter() if project_id != None else {}
+    total = collections.OrderedDict()
+    for d in records:
 
         if isinstance(d[field], float):
             d[field] = str(d[field])[:-2]        
         
         if 'project_id' in d:  
-            summary.setdefault(d['project_id'], {})
-            summary[d['project_id']].setdefault(d[field], 0)
-            summary[d['project_id']][d[field]] += 1
-            if d[field] not in total:
-                total.append(d[field])            
+            summary.setdefault(d['project_id'], collections.Counter())[d[field]] += 1
+            total[d[field]] = True
         else:
-            summary.setdefault(d[field], 0)        
             summary[d[field]] += 1
             
     #plot_summary(summary, field)
@@ -264,7 +1228,7 @@ def query_summary_field(node, field, project_id=None):
     if project_id != None:
         plot_field_metrics(summary, field)
     else:
-        plot_overall_metrics(summary, field, total)       
+        plot_overall_metrics(summary, field, list(total))       
     
     return summary
 
@@ -341,6 +1305,9 @@ def plot_overall_metrics(summary_counts, field, totals):
 def list_samples(project_id):
     ''' Retrieve samples included in one specific project'''
 
+    if offline(project_id):
+        return offline(project_id).list_samples()
+
     sample_data = query_project_samples(project_id)
 
     samples = []
@@ -350,70 +1317,120 @@ def list_samples(project_id):
     return samples       
 
 
-def query_experimental_metadata(project_id):
+def query_experimental_metadata(project_id, use_cache=True):
     ''' Query experimental metadata files from a specific project '''
 
 
     query_txt = """query Test { experiment (project_id: "%s") {   
                                experiment_metadata_files{file_name}}} """ % (project_id)
 
-    data = query_api(query_txt)   
+    data = query_api(query_txt, use_cache=use_cache)   
 
     return data
 
 
-def query_project(project_id):
+def query_project(project_id, batch_size=50, file_types=None):
     ''' Retrieve all sample data for one specific project '''
 
 
     data = query_project_samples(project_id)
-    for s in data['data']['sample']:
-      sample = query_sample(project_id, s['submitter_id'])
-      s.update(sample['data']['sample'][0])
+    samples = data['data']['sample']
+    batches = [samples[start:start + batch_size] for start in range(0, len(samples), batch_size)]
+    results = executor.map(query_samples, [(project_id, [s['submitter_id'] for s in batch], file_types)
+                                           for batch in batches])
+    for batch, result in zip(batches, results):
+      found = dict((r['submitter_id'], r) for r in result['data']['sample'])
+      for s in batch:
+        if s['submitter_id'] in found:
+          s.update(found[s['submitter_id']])
  
     return data
 
 
-def query_expectations(project_id, vcf_name):
+def query_expectations(project_id, vcf_name, page_size=1000):
     ''' Retrieve all expected mutations associated to one VCF in one project'''
 
-    query_txt = """{ 
-                   aliquot(project_id: "%s", with_path_to: {type: "submitted_somatic_mutation", file_name: "%s"}) {
-                       _contrived_expectations_count 
-                       samples{
-                           submitter_id
-                       }
-                       contrived_expectations(first:0) { 
-                          expected_mutation_chromosome 
-                          expected_mutation_position 
-                       }
-                   }
-                }""" % (project_id, vcf_name)
-
-    data = query_api(query_txt) 
-    
-    return data
+    fields = """expected_mutation_chromosome
+                expected_mutation_position
+                aliquots{
+                    submitter_id
+                    samples{
+                        submitter_id
+                    }
+                }"""
+    path = {'type': 'submitted_somatic_mutation', 'file_name': vcf_name}
 
+    # page the expectations themselves and regroup them under their aliquots
+    aliquots = collections.OrderedDict()
+    for e in iter_nodes('contrived_expectation', fields, page_size, project_id=project_id, with_path_to=path):
+        for a in e['aliquots']:
+            aliquot = aliquots.setdefault(a['submitter_id'], {'submitter_id': a['submitter_id'],
+                                                              'samples': a['samples'],
+                                                              'contrived_expectations': []})
+            aliquot['contrived_expectations'].append({'expected_mutation_chromosome': e['expected_mutation_chromosome'],
+                                                      'expected_mutation_position': e['expected_mutation_position']})
+    for aliquot in aliquots.values():
+        aliquot['_contrived_expectations_count'] = len(aliquot['contrived_expectations'])
 
-def search_files(query_data, file_type):
-    ''' Retrieve file names from a sample query result'''
+    return {'data': {'aliquot': list(aliquots.values())}}
+
+
+class FileIndex(object):
+    ''' File names of a project/sample indexed by data type and sample, with counts by extension '''
+
+    def __init__(self, file_types):
+        self.files = collections.OrderedDict((file_type, {}) for file_type in file_types)
+        self.metadata = []
+        self.extensions = collections.Counter()
+
+    def add(self, file_type, sample_id, file_name):
+        self.files[file_type][sample_id].append(file_name)
+        self.extensions[file_name.split('.')[-1]] += 1
+
+    def add_metadata(self, file_names):
+        for file_name in file_names:
+            self.metadata.append(file_name)
+            self.extensions[file_name.split('.')[-1]] += 1
 
-    node = data_types[file_type.upper()]
+    def all_files(self):
+        ''' Every file name, by data type then sample, followed by the metadata files '''
 
-    files = {}
+        files = []
+        for file_type in self.files:
+            for sample_id in self.files[file_type]:
+                files += self.files[file_type][sample_id]
 
+        return files + self.metadata
+
+
+def index_files(query_data, file_types=None):
+    ''' Walk a sample query result once and index its file names for every data type '''
+
+    if file_types is None:
+        file_types = data_types.keys()
+    file_types = [file_type.upper() for file_type in file_types]
+    nodes = [(data_types[file_type], file_type) for file_type in file_types]
+
+    index = FileIndex(file_types)
     for s in query_data["data"]["sample"]:
         sample_id = s['submitter_id'].encode('ascii')
-        if not sample_id in files:
-           files[sample_id] = []
+        for file_type in file_types:
+            index.files[file_type].setdefault(sample_id, [])
         for a in s['aliquots']:
             for an in a['analytes']:  
                 for rg in an['read_groups']:
-                    for f in rg[node]:
-                        if 'file_name' in f:
-                            files[sample_id].append(f['file_name'].encode('ascii'))
+                    for node, file_type in nodes:
+                        for f in rg.get(node) or []:
+                            if 'file_name' in f:
+                                index.add(file_type, sample_id, f['file_name'].encode('ascii'))
 
-    return files
+    return index
+
+
+def search_files(query_data, file_type):
+    ''' Retrieve file names from a sample query result'''
+
+    return index_files(query_data, [file_type]).files[file_type.upper()]
 
 
 def search_metadata(query_data, file_type):
@@ -436,66 +1453,94 @@ def list_files_by_type(project_id, file_type, sample_id=None):
 
     file_type = file_type.upper()
 
+    if offline(project_id):
+      if file_type == 'METADATA':
+        return offline(project_id).metadata_files()
+      return offline(project_id).file_index(sample_id, [file_type]).files[file_type]
+
     if file_type == 'METADATA':
       data = query_experimental_metadata(project_id)
       files = search_metadata(data, file_type)
     elif sample_id:
-      data = query_sample(project_id, sample_id)
+      data = query_sample(project_id, sample_id, [file_type])
       files = search_files(data, file_type)  
     else:
-      data = query_project(project_id) 
+      data = query_project(project_id, file_types=[file_type]) 
       files = search_files(data, file_type)
     
     return files   
 
 
-def list_files(project_id, sample_id=None):
-    ''' Retrieve all file names associated to a project/sample''' 
+def project_file_index(project_id, sample_id=None):
+    ''' Index every file of a project/sample walking the query result a single time '''
+
+    if offline(project_id):
+      return offline(project_id).file_index(sample_id)
 
     if sample_id:
-      data = query_sample(project_id, sample_id)  
-      files = []
-      for key in data_types.keys():
-          type_files = search_files(data, key) 
-          if type_files:
-             files += type_files[sample_id]
+      data = query_sample(project_id, sample_id, data_types.keys())  
+      index = index_files(data)
     else:
-      data = query_project(project_id)  
-      files = []
-      for key in data_types.keys():
-          type_files = search_files(data, key) 
-          if type_files:
-             for sample_id in type_files:
-                files += type_files[sample_id]    
+      data = query_project(project_id, file_types=data_types.keys())  
+      index = index_files(data)
 
       metadata = query_experimental_metadata(project_id)
       for key in metadata_types:
-          type_files = search_metadata(metadata, key) 
-          if type_files:
-             files += type_files    
+          index.add_metadata(search_metadata(metadata, key))
 
-    return files
+    return index
+
+
+def list_files(project_id, sample_id=None):
+    ''' Retrieve all file names associated to a project/sample''' 
+
+    return project_file_index(project_id, sample_id).all_files()
 
 
 def count_file_types(project_id, sample_id=None):
     ''' Count file types associated to a project/sample ''' 
 
+    return dict(project_file_index(project_id, sample_id).extensions)
+
+
+def chromosome_code(chrom):
+    ''' Encode a chromosome name as an integer (other contigs get sequential codes from 1000 on) '''
+
+    chrom = chrom.replace('chr', '')
+    if chrom.isdigit() and int(chrom) < 1000:
+        return int(chrom)
+    if chrom in chromosome_codes:
+        return chromosome_codes[chrom]
+
+    code = contig_codes.get(chrom)
+    if code is None:
+        with contig_codes_lock:
+            code = contig_codes.setdefault(chrom, 1000 + len(contig_codes))
+
+    return code
 
-    data_files = list_files(project_id, sample_id)
-    count_files = dict()
-    for f in data_files:
-       file_type = f.split('.')[-1]
-       if file_type in count_files:
-          count_files[file_type] += 1
-       else:
-          count_files[file_type] = 1        
 
-    return count_files
+def mutation_key(chrom, pos):
+    ''' Encode a chromosome/position pair as one integer '''
+
+    return chromosome_code(chrom) * 2 ** 32 + int(pos)
+
+
+def index_expectations(expectations):
+    ''' Build a set of encoded expected positions for constant-time lookups '''
+
+    if isinstance(expectations, ExpectedMutations):
+        return set(expectations.keys.tolist())
+
+    return set(mutation_key(var['expected_mutation_chromosome'], var['expected_mutation_position'])
+               for var in expectations)
 
 
 def get_expected_mutations(project_id, vcf_name):
     ''' Retrieve expected mutation from an expectation query ''' 
 
+    if offline(project_id):
+        return offline(project_id).expected_mutations(vcf_name)
 
     data = query_expectations(project_id, vcf_name)
 
@@ -511,88 +1556,511 @@ def get_expected_mutations(project_id, vcf_name):
     return expectations
 
 
+class ExpectedMutations(object):
+    ''' Expected mutations of one VCF stored as integer chromosome/position arrays '''
+
+    def __init__(self, sample_id, vcf, chromosomes, positions, names):
+        self.sample_id = sample_id
+        self.vcf = vcf
+        self.chromosomes = np.asarray(chromosomes, dtype=np.int64)
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.names = names
+        self.keys = self.chromosomes * 2 ** 32 + self.positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        return {'sample_id': self.sample_id, 'vcf': self.vcf,
+                'expected_mutation_chromosome': self.names[int(self.chromosomes[i])],
+                'expected_mutation_position': str(self.positions[i])}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, mask):
+        ''' Return the expectations selected by a boolean mask '''
+
+        return ExpectedMutations(self.sample_id, self.vcf, self.chromosomes[mask], self.positions[mask], self.names)
+
+
+class ExpectationIndex(dict):
+    ''' Expected mutations of a whole project keyed by VCF file name '''
+
+    def get_expected_mutations(self, vcf_name):
+        ''' Return the expectations of one VCF (empty if it has none) '''
+
+        if vcf_name in self:
+            return self[vcf_name]
+
+        return []
+
+
+def get_project_expectations(project_id, page_size=100):
+    ''' Retrieve every contrived expectation of a project in a few paginated calls and index them by VCF '''
+
+    if offline(project_id):
+        return offline(project_id).expectation_index()
+
+    fields = """submitter_id
+                samples{
+                    submitter_id
+                }
+                contrived_expectations(first:0) {
+                    expected_mutation_chromosome
+                    expected_mutation_position
+                }
+                analytes {
+                    read_groups {
+                        submitted_somatic_mutations { file_name }
+                    }
+                }"""
+
+    names = {}
+    samples = {}
+    chromosomes = {}
+    positions = {}
+    for a in iter_nodes('aliquot', fields, page_size, project_id=project_id,
+                        with_path_to={'type': 'contrived_expectation'}):
+        if not a['samples']:
+            continue
+        sample_id = a['samples'][0]['submitter_id'].encode('ascii')
+
+        codes = []
+        for se in a['contrived_expectations']:
+            chrom = se['expected_mutation_chromosome'].encode('ascii').replace('chr', '')
+            code = chromosome_code(chrom)
+            names[code] = chrom
+            codes.append((code, int(se['expected_mutation_position'])))
+
+        for an in a['analytes']:
+            for rg in an['read_groups']:
+                for f in rg['submitted_somatic_mutations']:
+                    vcf_name = f['file_name'].encode('ascii')
+                    samples.setdefault(vcf_name, sample_id)
+                    chromosomes.setdefault(vcf_name, []).extend(c for c, p in codes)
+                    positions.setdefault(vcf_name, []).extend(p for c, p in codes)
+
+    index = ExpectationIndex()
+    for vcf_name in samples:
+        if positions[vcf_name]:
+            index[vcf_name] = ExpectedMutations(samples[vcf_name], vcf_name, chromosomes[vcf_name],
+                                                positions[vcf_name], names)
+
+    return index
+
+
 def find_germlines(expectations, baseline):
     ''' Find potential germline variants from a baseline vcf (unexpected somatic variants) ''' 
 
     vcf_back = pysam.VariantFile(baseline, 'rb') 
 
-    for rec in vcf_back.fetch():
-      if 'PASS' in rec.filter:  
-        chrom = rec.chrom.replace('chr', '')
-        pos   = str(rec.pos)
-        ref   = rec.alleles[0]
-        alt   = rec.alleles[1]
-
+    germlines = set()
+    if vcf_back.index is not None:
+        # Indexed baseline: only fetch the expected positions
+        contigs = dict((c.replace('chr', ''), c) for c in vcf_back.header.contigs)
         for var in expectations:
-           if chrom == var['expected_mutation_chromosome'] and \
-              pos == var['expected_mutation_position']:
-                 expectations.remove(var)
+            contig = contigs.get(var['expected_mutation_chromosome'])
+            if contig is None:
+                continue
+            pos = int(var['expected_mutation_position'])
+            try:
+                records = vcf_back.fetch(contig, pos - 1, pos)
+            except ValueError:
+                continue
+            for rec in records:
+                if 'PASS' in rec.filter and rec.pos == pos:
+                    germlines.add(mutation_key(rec.chrom, rec.pos))
+    else:
+        # No index: a single pass over the baseline against the expectation set
+        expected = index_expectations(expectations)
+        for rec in vcf_back.fetch():
+            if 'PASS' in rec.filter:
+                key = mutation_key(rec.chrom, rec.pos)
+                if key in expected:
+                    germlines.add(key)
+
+    if isinstance(expectations, ExpectedMutations):
+        return expectations.select(~np.isin(expectations.keys, np.array(sorted(germlines), dtype=np.int64)))
+
+    return [var for var in expectations
+            if mutation_key(var['expected_mutation_chromosome'], var['expected_mutation_position']) not in germlines]
+
+
+def expectation_keys(expectations):
+    ''' Sorted array of the encoded expected positions '''
+
+    if isinstance(expectations, ExpectedMutations):
+        return np.unique(expectations.keys)
+
+    return np.array(sorted(index_expectations(expectations)), dtype=np.int64)
+
+
+def load_vcf_arrays(vcf_path):
+    ''' Load the PASS records of a VCF into columnar NumPy arrays in one pass '''
+
+    codes = {}
+    chroms = array.array('l')
+    positions = array.array('l')
+    mafs = array.array('d')
+    quals = array.array('d')
+    ref_lengths = array.array('l')
+    alt_lengths = array.array('l')
+
+    scanned = 0
+    vcf_in = pysam.VariantFile(vcf_path, 'rb') 
+    for rec in vcf_in.fetch():
+        scanned += 1
+        if 'PASS' not in rec.filter:
+            continue
+        if rec.chrom not in codes:
+            codes[rec.chrom] = chromosome_code(rec.chrom)
+        chroms.append(codes[rec.chrom])
+        positions.append(rec.pos)
+        mafs.append(float(rec.info['MAF'][0]) if 'MAF' in rec.info else np.nan)
+        quals.append(rec.qual if rec.qual is not None else np.nan)
+        ref_lengths.append(len(rec.ref))
+        alt_lengths.append(len(rec.alts[0]) if rec.alts else 0)
+
+    records = {
+        'chrom': np.frombuffer(chroms, dtype=chroms.typecode).astype(np.int64),
+        'pos': np.frombuffer(positions, dtype=positions.typecode).astype(np.int64),
+        'maf': np.frombuffer(mafs, dtype=np.float64).copy(),
+        'qual': np.frombuffer(quals, dtype=np.float64).copy(),
+        'ref_length': np.frombuffer(ref_lengths, dtype=ref_lengths.typecode).astype(np.int64),
+        'alt_length': np.frombuffer(alt_lengths, dtype=alt_lengths.typecode).astype(np.int64)
+    }
+    records['key'] = records['chrom'] * 2 ** 32 + records['pos']
+    records['scanned'] = scanned
+
+    return records
+
+
+def score_vcf_arrays(records, expected_keys, max_maf=0.1):
+    ''' Count true/false positives among the records under a MAF threshold with a vectorized join '''
+
+    keys = records['key'][records['maf'] < max_maf]
+    hits = np.isin(keys, expected_keys)
+    TP = int(np.count_nonzero(hits))
+
+    return TP, len(keys) - TP
+
+
+def metrics_row(sample_id, vcf_name, P, TP, FP, total=169):
+    ''' Build one MetricsTable row from the expectation and hit counts '''
+
+    TN = total - (TP + FP)
+
+    return {'Sample': sample_id, 'VCF File': vcf_name, 'Expectations': P,
+            'True-Positive': TP, 'False-Positive': FP,
+            'Sensitivity': round(float(TP)/float(P), 3),
+            'Specificity': round(float(TN)/float(TN+FP),3)}
+
+
+class PanelOfNormals(object):
+    ''' Germline positions of many baseline VCFs with a bitset of the baselines carrying each one '''
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.bits = np.load(os.path.join(path, 'bits.npy'), mmap_mode='r')
+        self.counts = np.load(os.path.join(path, 'counts.npy'), mmap_mode='r')
+        self.baselines = json.loads(open(os.path.join(path, 'baselines.json')).read())
+        contigs_path = os.path.join(path, 'contigs.json')
+        if os.path.exists(contigs_path):
+            self.translate_contigs(json.loads(open(contigs_path).read()))
+
+    def translate_contigs(self, contigs):
+        ''' Re-encode the positions on contigs whose code differs in this session (codes are given in order of use) '''
+
+        moved = [(code, chromosome_code(name.encode('ascii'))) for name, code in contigs.items()]
+        moved = [(code, new) for code, new in moved if code != new]
+        if not moved:
+            return
+
+        codes = np.asarray(self.keys) // 2 ** 32
+        keys = np.array(self.keys)
+        for code, new in moved:
+            keys[codes == code] += (new - code) * 2 ** 32
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.bits = np.asarray(self.bits)[order]
+        self.counts = np.asarray(self.counts)[order]
+
+    def lookup(self, keys):
+        ''' Row of each encoded position in the index, or -1 if no baseline carries it '''
+
+        keys = np.asarray(keys, dtype=np.int64)
+        rows = np.searchsorted(self.keys, keys)
+        found = rows < len(self.keys)
+        found[found] = self.keys[rows[found]] == keys[found]
+
+        return np.where(found, rows, -1)
+
+    def seen(self, keys, min_normals=1):
+        ''' Mask of the positions carried by at least min_normals baselines '''
+
+        rows = self.lookup(keys)
+        seen = rows >= 0
+        seen[seen] = self.counts[rows[seen]] >= min_normals
+
+        return seen
+
+    def carriers(self, chrom, pos):
+        ''' Names of the baselines carrying one position '''
+
+        row = self.lookup([mutation_key(chrom, pos)])[0]
+        if row < 0:
+            return []
+
+        return [name for i, name in enumerate(self.baselines) if self.bits[row, i // 8] & (1 << (i % 8))]
+
+    def filter(self, expectations, min_normals=1):
+        ''' Drop the expectations seen in at least min_normals baselines (potential germlines) '''
+
+        if isinstance(expectations, ExpectedMutations):
+            return expectations.select(~self.seen(expectations.keys, min_normals))
+
+        keys = [mutation_key(var['expected_mutation_chromosome'], var['expected_mutation_position'])
+                for var in expectations]
+        seen = self.seen(keys, min_normals)
+
+        return [var for var, germline in zip(expectations, seen) if not germline]
+
+
+def build_panel_of_normals(baselines, path):
+    ''' Parse many baseline VCFs once and persist their PASS positions as a memory-mappable index '''
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    baseline_keys = [np.unique(load_vcf_arrays(baseline)['key']) for baseline in baselines]
+    if baseline_keys:
+        keys = np.unique(np.concatenate(baseline_keys))
+    else:
+        keys = np.array([], dtype=np.int64)
+
+    bits = np.zeros((len(keys), (len(baselines) + 7) // 8), dtype=np.uint8)
+    counts = np.zeros(len(keys), dtype=np.uint16)
+    for i, baseline_key in enumerate(baseline_keys):
+        rows = np.searchsorted(keys, baseline_key)
+        bits[rows, i // 8] |= 1 << (i % 8)
+        counts[rows] += 1
+
+    np.save(os.path.join(path, 'keys.npy'), keys)
+    np.save(os.path.join(path, 'bits.npy'), bits)
+    np.save(os.path.join(path, 'counts.npy'), counts)
+    with open(os.path.join(path, 'baselines.json'), 'w') as f:
+        f.write(json.dumps([os.path.basename(baseline) for baseline in baselines]))
+    # Contig codes are only valid in this session, so the names are kept to translate them when loading
+    used = set(np.unique(keys // 2 ** 32).tolist())
+    with open(os.path.join(path, 'contigs.json'), 'w') as f:
+        f.write(json.dumps(dict((name, code) for name, code in contig_codes.items() if code in used)))
+
+    return PanelOfNormals(path)
+
+
+def filter_germlines(expectations, path, baseline_vcf=None, pon=None, min_normals=1):
+    ''' Remove potential germlines using a baseline VCF and/or a panel-of-normals index '''
+
+    if baseline_vcf:
+       expectations = find_germlines(expectations, path + baseline_vcf)
+    if pon is not None:
+       if isinstance(pon, basestring):
+          pon = PanelOfNormals(pon)
+       expectations = pon.filter(expectations, min_normals)
 
     return expectations
 
 
-def calculate_metrics_vcf(project, path, vcf_name, baseline_vcf=None):
+def calculate_metrics_vcf(project, path, vcf_name, baseline_vcf=None, expectations=None, pon=None, min_normals=1):
     ''' Calculate sensitivity/specificity for one VCF file and its corresponding expectations ''' 
 
-    data = {'Sample': '', 'VCF File': '', 'Expectations': 0, 'True-Positive': 0, 'False-Positive': 0, 'Sensitivity': 0.0 , 'Specificity': 0.0}
+    start = time.time()
     vcf_path = path + vcf_name
-    vcf_in = pysam.VariantFile(vcf_path, 'rb') 
 
-    expectations = get_expected_mutations(project, vcf_name)
+    if expectations is None:
+       expectations = get_expected_mutations(project, vcf_name)
     if not expectations:
        print "Warning: There are no expected mutations for %s VCF file" % vcf_name
        return {}
     
-    if baseline_vcf:
-       expectations = find_germlines(expectations, path + baseline_vcf)  
+    expectations = filter_germlines(expectations, path, baseline_vcf, pon, min_normals)
 
-    TP = 0
-    FP = 0
-    for rec in vcf_in.fetch():
-      if 'PASS' in rec.filter and float(rec.info['MAF'][0]) < 0.1:  
-        chrom = rec.chrom.replace('chr', '')
-        pos   = str(rec.pos)
-        ref   = rec.alleles[0]
-        alt   = rec.alleles[1]
-
-        # Not used yet
-        if len(ref)>1:
-           ref = ref[1:]
-           alt = '-'
-        if len(alt)>1:
-           alt = alt[1:]
-           ref = '-'             
-  
-        if any(var['expected_mutation_chromosome'] == chrom \
-           and var['expected_mutation_position'] == pos for var in expectations):
-              TP += 1
-        else:
-              FP += 1
+    parse_start = time.time()
+    records = load_vcf_arrays(vcf_path)
+    parse = time.time() - parse_start
+    TP, FP = score_vcf_arrays(records, expectation_keys(expectations))
     
-    sample_id = [var['sample_id'] for var in expectations][0]
-    P  = len(expectations)
-    TN = 169 - (TP + FP)
-    data['Sample'] = sample_id
-    data['VCF File'] = vcf_name
-    data['Expectations'] = P
-    data['True-Positive'] = TP
-    data['False-Positive'] = FP
-    data['Sensitivity'] = round(float(TP)/float(P), 3)
-    data['Specificity'] = round(float(TN)/float(TN+FP),3)         
+    sample_id = expectations[0]['sample_id']
+    data = metrics_row(sample_id, vcf_name, len(expectations), TP, FP)
+
+    if instrumentation is not None:
+        instrumentation.record('vcf', 'calculate_metrics_vcf', start, vcf=vcf_name, parse=parse,
+                               records=records['scanned'], passed=len(records['key']),
+                               expectations=len(expectations))
   
     return MetricsTable([data])
 
-def calculate_metrics_all_vcf(project, path, vcfs_files, samples=None, baseline_vcf=None):
+
+def score_vcf_curve(records, expected_keys, maf_cutoffs, qual_cutoffs=None):
+    ''' Count true/false positives at every MAF (and QUAL) cutoff from cumulative counts over sorted MAF values '''
+
+    maf_cutoffs = np.asarray(maf_cutoffs, dtype=np.float64)
+    hits = np.isin(records['key'], expected_keys)
+
+    counts = []
+    for qual in (qual_cutoffs if qual_cutoffs is not None else [None]):
+        selected = np.ones(len(hits), dtype=bool) if qual is None else records['qual'] >= qual
+        order = np.argsort(records['maf'][selected], kind='mergesort')
+        mafs = records['maf'][selected][order]
+        cumulative_hits = np.concatenate(([0], np.cumsum(hits[selected][order])))
+
+        # Records with MAF strictly below each cutoff (NaN sorts last and is never counted)
+        n = np.searchsorted(mafs, maf_cutoffs, side='left')
+        for maf, TP, total in zip(maf_cutoffs, cumulative_hits[n], n):
+            counts.append((float(maf), qual, int(TP), int(total - TP)))
+
+    return counts
+
+
+def calculate_curve_vcf(project, path, vcf_name, maf_cutoffs, qual_cutoffs=None, baseline_vcf=None, expectations=None,
+                        pon=None, min_normals=1):
+    ''' Calculate sensitivity/specificity of one VCF file at several MAF/QUAL cutoffs reading it once '''
+
+    if expectations is None:
+       expectations = get_expected_mutations(project, vcf_name)
+    if not expectations:
+       print "Warning: There are no expected mutations for %s VCF file" % vcf_name
+       return CurveTable()
+
+    expectations = filter_germlines(expectations, path, baseline_vcf, pon, min_normals)
+
+    records = load_vcf_arrays(path + vcf_name)
+    sample_id = expectations[0]['sample_id']
+
+    curve = CurveTable()
+    for maf, qual, TP, FP in score_vcf_curve(records, expectation_keys(expectations), maf_cutoffs, qual_cutoffs):
+        data = metrics_row(sample_id, vcf_name, len(expectations), TP, FP)
+        data['MAF Cutoff'] = maf
+        data['QUAL Cutoff'] = qual
+        curve.append(data)
+
+    return curve
+
+
+def aggregate_curves(curves):
+    ''' Sum the per-VCF curves into one cohort curve labelled by cutoff '''
+
+    totals = collections.OrderedDict()
+    for curve in curves:
+        for data in curve:
+            cutoff = (data['MAF Cutoff'], data['QUAL Cutoff'])
+            total = totals.setdefault(cutoff, {'P': 0, 'TP': 0, 'FP': 0, 'files': 0})
+            total['P'] += data['Expectations']
+            total['TP'] += data['True-Positive']
+            total['FP'] += data['False-Positive']
+            total['files'] += 1
+
+    cohort = CurveTable()
+    for (maf, qual), total in totals.items():
+        label = 'MAF < %g' % maf
+        if qual is not None:
+            label += ', QUAL >= %g' % qual
+        data = metrics_row('Cohort', label, total['P'], total['TP'], total['FP'], 169 * total['files'])
+        data['MAF Cutoff'] = maf
+        data['QUAL Cutoff'] = qual
+        cohort.append(data)
+
+    return cohort
+
+
+def calculate_curves_all_vcf(project, path, vcfs_files, maf_cutoffs, qual_cutoffs=None, samples=None, baseline_vcf=None,
+                             pon=None, min_normals=1):
+    ''' Calculate a metrics curve for a set of VCF files and aggregate them into a cohort curve '''
+
+    vcfs = []
+    for sample in vcfs_files:
+       if samples is None or sample in samples:
+           vcfs += vcfs_files[sample]
+
+    index = get_project_expectations(project)
+    if isinstance(pon, basestring):
+       pon = PanelOfNormals(pon)
+
+    curves = collections.OrderedDict()
+    for vcf in vcfs:
+       curve = calculate_curve_vcf(project, path, vcf, maf_cutoffs, qual_cutoffs, baseline_vcf,
+                                   index.get_expected_mutations(vcf), pon, min_normals)
+       if curve:
+          curves[vcf] = curve
+
+    return curves, aggregate_curves(curves.values())
+
+
+def calculate_metrics_task(task):
+    ''' Run calculate_metrics_vcf for one VCF in a worker process, returning the error instead of raising '''
+
+    global instrumentation
+
+    project, path, vcf, baseline_vcf, expectations, pon, min_normals, contigs = task
+    # Use the parent's contig codes, which the expectations were encoded with
+    contig_codes.update(contigs)
+    # The worker's copy of the parent's instrumentation only collects events, which are sent back with the result
+    if instrumentation is not None:
+        instrumentation = Instrumentation()
+    try:
+        data, error = calculate_metrics_vcf(project, path, vcf, baseline_vcf, expectations, pon, min_normals), None
+    except Exception as e:
+        data, error = None, '%s: %s' % (type(e).__name__, e)
+
+    return data, error, instrumentation.events if instrumentation is not None else []
+
+
+def calculate_metrics_all_vcf(project, path, vcfs_files, samples=None, baseline_vcf=None, workers=None,
+                              pon=None, min_normals=1):
     ''' Calculate sensitivity/specificity for a set of VCF files and create a table ''' 
 
     data_results = []
 
+    vcfs = []
     for sample in vcfs_files:
-       if sample in samples:
-           for vcf in vcfs_files[sample]:       
-              data = calculate_metrics_vcf(project, path, vcf, baseline_vcf)
-              if data:
-                 data_results = data_results + data
+       if samples is None or sample in samples:
+           vcfs += vcfs_files[sample]
+
+    # Expectations for the whole project are fetched once and shared by every VCF
+    index = get_project_expectations(project)
+    all_expectations = [index.get_expected_mutations(vcf) for vcf in vcfs]
+
+    if workers and workers > 1:
+       # VCF parsing is CPU-bound: spread files across processes, results keep the input order
+       # Workers memory-map the panel of normals themselves instead of receiving a pickled copy
+       pon_path = pon.path if isinstance(pon, PanelOfNormals) else pon
+       tasks = [(project, path, vcf, baseline_vcf, expectations, pon_path, min_normals, dict(contig_codes))
+                for vcf, expectations in zip(vcfs, all_expectations)]
+       pool = multiprocessing.Pool(min(workers, max(1, len(tasks))))
+       try:
+          results = pool.map(calculate_metrics_task, tasks, chunksize=1)
+       finally:
+          pool.close()
+          pool.join()
+
+       for vcf, (data, error, events) in zip(vcfs, results):
+          if instrumentation is not None:
+             for event in events:
+                instrumentation.add(event)
+          if error:
+             print "ERROR: %s failed (%s)" % (vcf, error)
+          elif data:
+             data_results = data_results + data
+    else:
+       if isinstance(pon, basestring):
+          pon = PanelOfNormals(pon)
+       for vcf, expectations in zip(vcfs, all_expectations):
+          data = calculate_metrics_vcf(project, path, vcf, baseline_vcf, expectations, pon, min_normals)
+          if data:
+             data_results = data_results + data
 
     table = MetricsTable(data_results)
 
@@ -634,3 +2102,370 @@ def plot_metrics(data_metrics, data_filter_metrics=None):
 
     ax.legend(rects, labels, loc='center left', bbox_to_anchor=(1, 0.5))
     plt.show()    
+
+
+snapshot_file_nodes = {
+    'submitted_somatic_mutations': 'submitted_somatic_mutation',
+    'submitted_unaligned_reads_files': 'submitted_unaligned_reads',
+    'submitted_aligned_reads_files': 'submitted_aligned_reads',
+    'submitted_copy_number_files': 'submitted_copy_number'
+}
+
+snapshot_summary_fields = {
+    'contrived_expectation': ['expected_mutation_gene'],
+    'diagnosis': ['primary_diagnosis']
+}
+
+
+class ProjectSnapshot(object):
+    ''' Local SQLite mirror of a project's samples, files, experiments and expectations '''
+
+    def __init__(self, project_id, path, summary_fields=None):
+        self.project_id = project_id
+        self.path = path
+        self.summary_fields = summary_fields if summary_fields is not None else snapshot_summary_fields
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_type TEXT,
+                id TEXT,
+                updated_datetime TEXT,
+                data TEXT,
+                PRIMARY KEY (node_type, id)
+            );
+            CREATE TABLE IF NOT EXISTS node_samples (
+                id TEXT PRIMARY KEY,
+                sample_id TEXT
+            );
+            CREATE TABLE IF NOT EXISTS samples (
+                sample_id TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                sample_id TEXT,
+                file_type TEXT,
+                file_name TEXT
+            );
+            CREATE TABLE IF NOT EXISTS metadata_files (
+                file_name TEXT
+            );
+            CREATE TABLE IF NOT EXISTS expectations (
+                id TEXT,
+                aliquot_id TEXT,
+                sample_id TEXT,
+                vcf TEXT,
+                chromosome TEXT,
+                position INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS node_samples_sample ON node_samples (sample_id);
+            CREATE INDEX IF NOT EXISTS files_type ON files (file_type, sample_id);
+            CREATE INDEX IF NOT EXISTS files_sample ON files (sample_id);
+            CREATE INDEX IF NOT EXISTS expectations_vcf ON expectations (vcf);
+            CREATE INDEX IF NOT EXISTS expectations_id ON expectations (id);
+            CREATE INDEX IF NOT EXISTS expectations_aliquot ON expectations (aliquot_id);
+        ''')
+        self.conn.commit()
+
+    def tree_fields(self):
+        ''' Sample -> file selection carrying the id of every node to map later changes back to samples '''
+
+        leaves = ' '.join('%s { id file_name }' % node for node in snapshot_file_nodes)
+
+        return """submitter_id id aliquots { id analytes { id read_groups { id %s }}}""" % (leaves)
+
+    def list_changes(self, node_type, fields='id updated_datetime'):
+        ''' Compare the current node listing with the stored one, returning (listing, changed ids, deleted ids) '''
+
+        stored = dict(self.conn.execute('SELECT id, updated_datetime FROM nodes WHERE node_type = ?',
+                                        (node_type,)).fetchall())
+        listing = list(iter_nodes(node_type, fields, project_id=self.project_id, use_cache=False))
+        current = set()
+        changed = []
+        for record in listing:
+            current.add(record['id'])
+            if stored.get(record['id']) != record['updated_datetime']:
+                changed.append(record['id'])
+
+        return listing, changed, [i for i in stored if i not in current]
+
+    def save_listing(self, node_type, listing):
+        self.conn.execute('DELETE FROM nodes WHERE node_type = ?', (node_type,))
+        self.conn.executemany('INSERT INTO nodes (node_type, id, updated_datetime, data) VALUES (?, ?, ?, ?)',
+                              [(node_type, r['id'], r['updated_datetime'], json.dumps(r)) for r in listing])
+
+    def sample_of(self, node_type, node_id):
+        ''' Find the sample a new node belongs to '''
+
+        samples = list(iter_nodes('sample', 'submitter_id', project_id=self.project_id, use_cache=False,
+                                  with_path_to={'type': node_type, 'id': node_id}))
+
+        return [s['submitter_id'] for s in samples]
+
+    def refresh_samples(self, sample_ids, batch_size=50):
+        ''' Re-fetch the file trees of some samples and replace their rows, returning the aliquots involved '''
+
+        sample_ids = sorted(set(sample_ids))
+        fields = self.tree_fields()
+        batches = [sample_ids[start:start + batch_size] for start in range(0, len(sample_ids), batch_size)]
+
+        def fetch(batch):
+            query_txt = "{ "
+            for i, sample_id in enumerate(batch):
+                query_txt += """s%d: sample (project_id: "%s", submitter_id: "%s") { %s } """ % (
+                    i, self.project_id, sample_id, fields)
+            data = query_api(query_txt + "}", use_cache=False)
+            samples = []
+            for i in range(len(batch)):
+                samples += (data.get('data') or {}).get('s%d' % i) or []
+            return samples
+
+        aliquot_ids = set()
+        for batch, samples in zip(batches, executor.map(fetch, [(batch,) for batch in batches])):
+            for sample_id in batch:
+                aliquot_ids.update(r[0] for r in self.conn.execute('SELECT DISTINCT aliquot_id FROM expectations '
+                                                                   'WHERE sample_id = ?', (sample_id,)))
+                self.conn.execute('DELETE FROM samples WHERE sample_id = ?', (sample_id,))
+                self.conn.execute('DELETE FROM files WHERE sample_id = ?', (sample_id,))
+                self.conn.execute('DELETE FROM node_samples WHERE sample_id = ?', (sample_id,))
+            for s in samples:
+                sample_id = s['submitter_id']
+                node_ids = [s['id']]
+                self.conn.execute('INSERT INTO samples (sample_id) VALUES (?)', (sample_id,))
+                for a in s['aliquots']:
+                    node_ids.append(a['id'])
+                    aliquot_ids.add(a['id'])
+                    for an in a['analytes']:
+                        node_ids.append(an['id'])
+                        for rg in an['read_groups']:
+                            node_ids.append(rg['id'])
+                            for file_type, node in data_types.items():
+                                for f in rg.get(node) or []:
+                                    node_ids.append(f['id'])
+                                    self.conn.execute('INSERT INTO files (sample_id, file_type, file_name) '
+                                                      'VALUES (?, ?, ?)', (sample_id, file_type, f['file_name']))
+                self.conn.executemany('INSERT OR REPLACE INTO node_samples (id, sample_id) VALUES (?, ?)',
+                                      [(node_id, sample_id) for node_id in node_ids])
+
+        return aliquot_ids
+
+    def refresh_expectations(self, aliquot_ids=None, page_size=100):
+        ''' Re-fetch the contrived expectations of some aliquots (or of the whole project) '''
+
+        fields = """id
+                    samples { submitter_id }
+                    contrived_expectations(first:0) {
+                        id
+                        expected_mutation_chromosome
+                        expected_mutation_position
+                    }
+                    analytes { read_groups { submitted_somatic_mutations { file_name }}}"""
+
+        if aliquot_ids is None:
+            self.conn.execute('DELETE FROM expectations')
+            aliquots = iter_nodes('aliquot', fields, page_size, project_id=self.project_id, use_cache=False,
+                                  with_path_to={'type': 'contrived_expectation'})
+        else:
+            aliquot_ids = sorted(set(aliquot_ids))
+            for aliquot_id in aliquot_ids:
+                self.conn.execute('DELETE FROM expectations WHERE aliquot_id = ?', (aliquot_id,))
+            results = executor.map(lambda aliquot_id: list(iter_nodes('aliquot', fields, page_size, use_cache=False,
+                                                                      project_id=self.project_id, id=aliquot_id)),
+                                   [(aliquot_id,) for aliquot_id in aliquot_ids])
+            aliquots = [a for result in results for a in result]
+
+        for a in aliquots:
+            if not a['samples']:
+                continue
+            sample_id = a['samples'][0]['submitter_id']
+            vcfs = [f['file_name'] for an in a['analytes'] for rg in an['read_groups']
+                    for f in rg['submitted_somatic_mutations']]
+            self.conn.executemany('INSERT INTO expectations (id, aliquot_id, sample_id, vcf, chromosome, position) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)',
+                                  [(se['id'], a['id'], sample_id, vcf,
+                                    se['expected_mutation_chromosome'].replace('chr', ''),
+                                    int(se['expected_mutation_position']))
+                                   for se in a['contrived_expectations'] for vcf in vcfs])
+
+    def refresh(self):
+        ''' Mirror the project, re-fetching only the nodes whose updated_datetime changed '''
+
+        full = self.conn.execute('SELECT COUNT(*) FROM nodes').fetchone()[0] == 0
+
+        # Sample file trees
+        listings = {}
+        changes = {}
+        samples = set()
+        unknown = []
+        for node_type in ['sample', 'aliquot', 'analyte', 'read_group'] + snapshot_file_nodes.values():
+            fields = 'id submitter_id updated_datetime' if node_type == 'sample' else 'id updated_datetime'
+            listing, changed, deleted = self.list_changes(node_type, fields)
+            listings[node_type] = listing
+            changes[node_type] = changed
+            if node_type == 'sample':
+                submitter_ids = dict((r['id'], r['submitter_id']) for r in listing)
+                samples.update(submitter_ids[i] for i in changed)
+            for node_id in changed + deleted:
+                row = self.conn.execute('SELECT sample_id FROM node_samples WHERE id = ?', (node_id,)).fetchone()
+                if row:
+                    samples.add(row[0])
+                elif node_type != 'sample':
+                    unknown.append((node_type, node_id))
+        # Deleted samples are re-fetched too, which just drops their rows
+        # The VCFs of their aliquots may have changed, so those expectations are re-fetched as well
+        refreshed_aliquots = self.refresh_samples(samples)
+
+        # New nodes under samples that did not change themselves
+        unknown = [(t, i) for t, i in unknown
+                   if not self.conn.execute('SELECT 1 FROM node_samples WHERE id = ?', (i,)).fetchone()]
+        if unknown:
+            located = executor.map(self.sample_of, unknown)
+            refreshed_aliquots |= self.refresh_samples([s for found in located for s in found])
+
+        # Contrived expectations, re-fetched per changed aliquot
+        listing, changed, deleted = self.list_changes('contrived_expectation')
+        listings['contrived_expectation'] = listing
+        if full:
+            self.refresh_expectations()
+        else:
+            aliquots = set(changes['aliquot']) | refreshed_aliquots
+            for node_id in changed + deleted:
+                row = self.conn.execute('SELECT aliquot_id FROM expectations WHERE id = ?', (node_id,)).fetchone()
+                if row:
+                    aliquots.add(row[0])
+                else:
+                    aliquots.update(a['id'] for a in iter_nodes('aliquot', 'id', project_id=self.project_id,
+                                                                use_cache=False, with_path_to={'type': 'contrived_expectation',
+                                                                              'id': node_id}))
+            if aliquots:
+                self.refresh_expectations(aliquots)
+
+        # Experiment metadata is small and fetched whole
+        self.conn.execute('DELETE FROM metadata_files')
+        metadata = query_experimental_metadata(self.project_id, use_cache=False)
+        for key in metadata_types:
+            self.conn.executemany('INSERT INTO metadata_files (file_name) VALUES (?)',
+                                  [(f,) for f in search_metadata(metadata, key)])
+
+        # Nodes summarized by query_summary_field
+        for node, fields in self.summary_fields.items():
+            listings[node] = list(iter_nodes(node, ['id', 'updated_datetime'] + fields, project_id=self.project_id,
+                                             use_cache=False))
+
+        for node_type, listing in listings.items():
+            self.save_listing(node_type, listing)
+        self.conn.commit()
+
+        return self
+
+    def list_samples(self):
+        return [r[0].encode('ascii') for r in self.conn.execute('SELECT sample_id FROM samples ORDER BY sample_id')]
+
+    def file_index(self, sample_id=None, file_types=None):
+        ''' FileIndex of the project (with metadata files) or of one sample '''
+
+        if file_types is None:
+            file_types = data_types.keys()
+        file_types = [file_type.upper() for file_type in file_types]
+
+        index = FileIndex(file_types)
+        if sample_id:
+            sample_ids = [sample_id]
+        else:
+            sample_ids = self.list_samples()
+        for file_type in file_types:
+            for s in sample_ids:
+                index.files[file_type][s] = []
+
+        query = 'SELECT sample_id, file_type, file_name FROM files'
+        if sample_id:
+            rows = self.conn.execute(query + ' WHERE sample_id = ?', (sample_id,))
+        else:
+            rows = self.conn.execute(query)
+        for s, file_type, file_name in rows:
+            if file_type in index.files:
+                index.add(file_type, s.encode('ascii'), file_name.encode('ascii'))
+
+        if not sample_id:
+            index.add_metadata([r[0].encode('ascii') for r in self.conn.execute('SELECT file_name FROM metadata_files')])
+
+        return index
+
+    def metadata_files(self):
+        return [r[0].encode('ascii') for r in self.conn.execute('SELECT file_name FROM metadata_files')]
+
+    def iter_summary_records(self, node, field):
+        ''' Stored records of a node carrying the requested field, or None if it was not mirrored '''
+
+        if field not in self.summary_fields.get(node, []):
+            return None
+
+        return (json.loads(r[0]) for r in self.conn.execute('SELECT data FROM nodes WHERE node_type = ?', (node,)))
+
+    def expected_mutations(self, vcf_name):
+        ''' Expected mutations of one VCF as ExpectedMutations (empty list if none) '''
+
+        rows = self.conn.execute('SELECT sample_id, chromosome, position FROM expectations WHERE vcf = ? '
+                                 'ORDER BY rowid', (vcf_name,)).fetchall()
+        if not rows:
+            return []
+
+        names = {}
+        for r in rows:
+            names[chromosome_code(r[1].encode('ascii'))] = r[1].encode('ascii')
+
+        return ExpectedMutations(rows[0][0].encode('ascii'), vcf_name,
+                                 [chromosome_code(r[1].encode('ascii')) for r in rows], [r[2] for r in rows], names)
+
+    def expectation_index(self):
+        index = ExpectationIndex()
+        for (vcf_name,) in self.conn.execute('SELECT DISTINCT vcf FROM expectations').fetchall():
+            index[vcf_name.encode('ascii')] = self.expected_mutations(vcf_name)
+
+        return index
+
+
+snapshot = None
+
+
+def snapshot_project(project_id, path, summary_fields=None):
+    ''' Mirror (or incrementally refresh) a project into a local SQLite store and answer queries from it '''
+
+    global snapshot
+
+    snapshot = ProjectSnapshot(project_id, path, summary_fields).refresh()
+
+    return snapshot
+
+
+def use_snapshot(project_id, path, summary_fields=None):
+    ''' Answer queries for a project from an existing local store without contacting the API '''
+
+    global snapshot
+
+    # connecting would silently create an empty store and every offline answer would be empty
+    if not os.path.isfile(path):
+        raise IOError('No project snapshot at %s, create it with snapshot_project' % path)
+    store = ProjectSnapshot(project_id, path, summary_fields)
+    if store.conn.execute('SELECT COUNT(*) FROM nodes').fetchone()[0] == 0:
+        store.conn.close()
+        raise ValueError('The project snapshot at %s is empty, create it with snapshot_project' % path)
+
+    snapshot = store
+
+    return snapshot
+
+
+def close_snapshot():
+    ''' Query the API again '''
+
+    global snapshot
+
+    snapshot = None
+
+
+def offline(project_id):
+    ''' Snapshot able to answer for a project, if any '''
+
+    if snapshot is not None and snapshot.project_id == project_id:
+        return snapshot
+
+    return None